@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import os
+import multiprocessing
+import re
+import subprocess
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from moviepy.config import get_setting
+
+from ffmpeg_backend import probe_video, run_ffmpeg
+from segment_cache import file_digest
+
+ALIGNMENT_TASK_CONFIG = "task_language=eng|is_text_type=plain|os_task_file_format=json"
+
+# Lines per chunk when the text has no blank lines separating paragraphs
+ALIGNMENT_CHUNK_LINES = 25
+
+# Paragraphs are cut apart in pauses at least this long and this quiet, looked for at most this
+# share of the narration away from where the length of the text before them puts the boundary
+SILENCE_NOISE_DB = -35
+SILENCE_MIN_SECONDS = 0.3
+BOUNDARY_SEARCH_SHARE = 0.1
+
+
+def run_alignment(audio_file: Path, txt_file: Path, task_config: str = ALIGNMENT_TASK_CONFIG) -> List[Dict]:
+    # aeneas is only imported when a pair actually has to be aligned, cached jobs never load it
+    from aeneas.executetask import ExecuteTask
+    from aeneas.task import Task
+
+    with tempfile.TemporaryDirectory(prefix="alignment_") as work_dir:
+        sync_map_file = Path(work_dir) / "sync_map.json"
+        task = Task(config_string=task_config)
+        task.audio_file_path_absolute = Path(audio_file).resolve().as_posix()
+        task.text_file_path_absolute = Path(txt_file).resolve().as_posix()
+        task.sync_map_file_path_absolute = sync_map_file.as_posix()
+        ExecuteTask(task).execute()
+        task.output_sync_map_file()
+        with open(sync_map_file, 'r') as f:
+            return json.load(f)['fragments']
+
+
+def split_text_into_chunks(lines: List[str], chunk_lines: int = ALIGNMENT_CHUNK_LINES) -> List[List[str]]:
+    # Paragraphs are separated by blank lines; a text without any is cut every chunk_lines lines
+    paragraphs = [[]]
+    for line in lines:
+        if line.strip():
+            paragraphs[-1].append(line)
+        elif paragraphs[-1]:
+            paragraphs.append([])
+    paragraphs = [paragraph for paragraph in paragraphs if paragraph]
+    if len(paragraphs) > 1:
+        return paragraphs
+    return [lines[i:i + chunk_lines] for i in range(0, len(lines), chunk_lines) if lines[i:i + chunk_lines]]
+
+
+def detect_silences(audio_file: Path) -> (float, List[Tuple[float, float]]):
+    # The narration's duration and its pauses, from ffmpeg's silencedetect; decodes the audio only
+    command = [
+        get_setting("FFMPEG_BINARY"), "-hide_banner", "-nostats", "-i", Path(audio_file).as_posix(),
+        "-af", f"silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_SECONDS}", "-f", "null", "-"
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = result.stderr.decode('utf-8', 'replace')
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if result.returncode != 0 or duration is None:
+        raise RuntimeError(f"Could not detect the pauses of {audio_file}: {output[-2000:]}")
+    duration = int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+    starts = [max(0.0, float(start)) for start in re.findall(r"silence_start: (-?\d+(?:\.\d+)?)", output)]
+    ends = [float(end) for end in re.findall(r"silence_end: (\d+(?:\.\d+)?)", output)]
+    # A pause running to the end of the audio has no end line
+    return duration, list(zip(starts, ends + [duration] * (len(starts) - len(ends))))
+
+
+def chunk_boundaries(chunks: List[List[str]], duration: float, silences: List[Tuple[float, float]]) -> Optional[List[float]]:
+    # Where each chunk starts and the last one ends: the middle of the pause nearest to the time the
+    # share of text before the chunk would take at an even pace. None when a boundary has no pause near it.
+    lengths = [sum(len(line.strip()) for line in chunk) for chunk in chunks]
+    window = BOUNDARY_SEARCH_SHARE * duration
+    boundaries = [0.0]
+    text_before = 0
+    for length in lengths[:-1]:
+        text_before += length
+        expected = duration * text_before / sum(lengths)
+        candidates = [
+            (start + end) / 2 for start, end in silences
+            if boundaries[-1] < (start + end) / 2 < duration and abs((start + end) / 2 - expected) <= window
+        ]
+        if not candidates:
+            return None
+        boundaries.append(min(candidates, key=lambda middle: abs(middle - expected)))
+    return boundaries + [duration]
+
+
+def align_chunk(audio_file: Path, txt_file: Path, offset: float, task_config: str) -> List[Dict]:
+    fragments = run_alignment(audio_file, txt_file, task_config)
+    for fragment in fragments:
+        fragment['begin'] = f"{float(fragment['begin']) + offset:.3f}"
+        fragment['end'] = f"{float(fragment['end']) + offset:.3f}"
+    return fragments
+
+
+def run_chunked_alignment(audio_file: Path, txt_file: Path, task_config: str, workers: int) -> List[Dict]:
+    # Every paragraph is cut out at a pause near where its share of the text puts it, then the
+    # paragraphs are aligned line by line against their own stretch of audio in parallel and shifted
+    # back in place. Only when a boundary has no pause near it is a full coarse pass run to place them.
+    with open(txt_file, 'r') as f:
+        lines = [line.rstrip("\n") for line in f]
+    chunks = split_text_into_chunks(lines)
+    if len(chunks) <= 1:
+        return run_alignment(audio_file, txt_file, task_config)
+
+    with tempfile.TemporaryDirectory(prefix="alignment_chunks_") as work_dir:
+        work_dir = Path(work_dir)
+        boundaries = chunk_boundaries(chunks, *detect_silences(audio_file))
+        if boundaries is not None:
+            spans = list(zip(boundaries, boundaries[1:]))
+            logging.info(f"Split {audio_file} into {len(spans)} paragraphs at pauses")
+        else:
+            logging.warning(f"No pause near every paragraph boundary of {audio_file}, locating the paragraphs with a full alignment")
+            coarse_txt_file = work_dir / "paragraphs.txt"
+            coarse_txt_file.write_text("\n".join(" ".join(line.strip() for line in chunk) for chunk in chunks) + "\n")
+            paragraphs = run_alignment(audio_file, coarse_txt_file, task_config)
+            spans = [(float(paragraph['begin']), float(paragraph['end'])) for paragraph in paragraphs]
+            logging.info(f"Located {len(spans)} paragraphs in {audio_file}")
+
+        chunk_jobs = []
+        for index, (chunk, (begin, end)) in enumerate(zip(chunks, spans)):
+            chunk_audio_file = work_dir / f"chunk_{index:04d}.wav"
+            run_ffmpeg(["-ss", f"{begin:.3f}", "-t", f"{end - begin:.3f}", "-i", audio_file, "-ac", "1", chunk_audio_file])
+            chunk_txt_file = work_dir / f"chunk_{index:04d}.txt"
+            chunk_txt_file.write_text("\n".join(chunk) + "\n")
+            chunk_jobs.append((chunk_audio_file, chunk_txt_file, begin))
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(align_chunk, *job, task_config) for job in chunk_jobs]
+            fragments = [fragment for future in futures for fragment in future.result()]
+    for index, fragment in enumerate(fragments):
+        fragment['id'] = f"f{index + 1:06d}"
+    return fragments
+
+
+def alignment_cache_key(audio_file: Path, txt_file: Path, task_config: str, chunked: bool) -> str:
+    payload = json.dumps({
+        "audio": file_digest(audio_file),
+        "text": file_digest(txt_file),
+        "task_config": task_config,
+        "chunked": chunked
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cached_alignment_file(audio_file: Path, txt_file: Path, cache_dir: Path, chunked: bool, task_config: str) -> Path:
+    return Path(cache_dir) / f"{alignment_cache_key(audio_file, txt_file, task_config, chunked)}.json"
+
+
+def cached_alignment(
+    audio_file: Path,
+    txt_file: Path,
+    cache_dir: Optional[Path],
+    chunked: bool = False,
+    task_config: str = ALIGNMENT_TASK_CONFIG
+) -> Optional[List[Dict]]:
+    if cache_dir is None:
+        return None
+    cache_file = cached_alignment_file(audio_file, txt_file, cache_dir, chunked, task_config)
+    if not cache_file.exists():
+        return None
+    with open(cache_file, 'r') as f:
+        return json.load(f)['fragments']
+
+
+def proportional_fragments(audio_file: Path, txt_file: Path) -> List[Dict]:
+    # Sync map fragments without aligning: the lines spread over the narration in proportion to
+    # their length, as an even pace would read them. Good enough to plan a job, not to subtitle it.
+    with open(txt_file, 'r') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    duration = probe_video(Path(audio_file))["duration"]
+    total = sum(len(line) for line in lines) or 1
+    fragments = []
+    begin = 0.0
+    for index, line in enumerate(lines):
+        end = begin + duration * len(line) / total
+        fragments.append({"id": f"f{index + 1:06d}", "begin": f"{begin:.3f}", "end": f"{end:.3f}", "lines": [line]})
+        begin = end
+    return fragments
+
+
+def align_text_to_audio(
+    audio_file: Path,
+    txt_file: Path,
+    cache_dir: Optional[Path] = None,
+    chunked: bool = False,
+    workers: Optional[int] = None,
+    task_config: str = ALIGNMENT_TASK_CONFIG
+) -> List[Dict]:
+    # Sync map fragments as written by aeneas, cached on (audio digest, text digest, task config)
+    fragments = cached_alignment(audio_file, txt_file, cache_dir, chunked, task_config)
+    if fragments is not None:
+        logging.info(f"Reused cached alignment for {audio_file} and {txt_file}")
+        return fragments
+
+    if chunked:
+        fragments = run_chunked_alignment(audio_file, txt_file, task_config, workers or os.cpu_count() or 1)
+    else:
+        fragments = run_alignment(audio_file, txt_file, task_config)
+
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        cache_file = cached_alignment_file(audio_file, txt_file, cache_dir, chunked, task_config)
+        temporary_file = cache_file.with_name(f".{cache_file.name}.{uuid.uuid4().hex}")
+        with open(temporary_file, 'w') as f:
+            json.dump({"fragments": fragments}, f)
+        os.replace(temporary_file, cache_file)
+    return fragments
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Aligns one pair into the cache ahead of a render job, which then finds it there
+    parser = argparse.ArgumentParser(description="Align a text to its narration")
+    parser.add_argument("--input_mp3", "-im", required=True, help="Input mp3 file")
+    parser.add_argument("--input_txt", "-it", required=True, help="Input txt file")
+    parser.add_argument("--alignment_cache_dir", "-acd", required=True,
+                        help="Directory keeping forced alignments of mp3/txt pairs across jobs")
+    parser.add_argument("--chunked_alignment", "-ca", action="store_true",
+                        help="Align paragraphs of long narrations in parallel and stitch the timings")
+
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    align_text_to_audio(Path(args.input_mp3), Path(args.input_txt), cache_dir=args.alignment_cache_dir, chunked=args.chunked_alignment)
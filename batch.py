@@ -0,0 +1,231 @@
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from segment_cache import file_digest
+
+# Manifest keys of a job, named like the test.py arguments
+JOB_FILE_KEYS = ("input_clips", "input_video", "input_mp3", "input_txt", "output_dir")
+JOB_OPTION_KEYS = ("render_mode", "backend", "smart_cut", "preview", "workers", "targets")
+
+
+def read_manifest(manifest_file: Path) -> List[Dict]:
+    # One job per line; relative paths are taken from the manifest's directory
+    jobs = []
+    with open(manifest_file, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            missing = [key for key in JOB_FILE_KEYS if key not in entry]
+            if missing:
+                raise ValueError(f"{manifest_file}:{line_number} is missing {', '.join(missing)}")
+            job = {key: (manifest_file.parent / entry[key]).as_posix() for key in JOB_FILE_KEYS}
+            job.update({key: entry[key] for key in JOB_OPTION_KEYS if key in entry})
+            job["id"] = str(entry.get("id", line_number))
+            jobs.append(job)
+    return jobs
+
+
+def cache_group(job: Dict) -> tuple:
+    # Jobs on the same base video and narration share the alignment, the base segments, the keyframe
+    # index and the subtitle rasters; files are compared by content, copies of an input count as the same
+    return tuple(file_digest(Path(job[key])) if Path(job[key]).exists() else job[key] for key in ("input_video", "input_mp3", "input_txt"))
+
+
+def schedule_groups(jobs: List[Dict]) -> List[List[Dict]]:
+    # Largest groups first, so their caches are warm before the long tail of small ones starts
+    groups = {}
+    for job in jobs:
+        try:
+            key = cache_group(job)
+        except OSError:
+            key = (job["id"],)
+        groups.setdefault(key, []).append(job)
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def job_result(job: Dict, state: str, error: Optional[str], elapsed: Optional[float], report: Optional[Dict] = None) -> Dict:
+    report = report or {}
+    return {
+        "id": job["id"],
+        "state": state,
+        "error": error,
+        "elapsed_seconds": elapsed,
+        "stages": {name: round(totals["seconds"], 3) for name, totals in report.get("stages", {}).items()},
+        "frames_encoded": report.get("frames_encoded"),
+        "worker_pid": os.getpid() if elapsed is not None else None,
+        "output_dir": job["output_dir"]
+    }
+
+
+def run_batch_jobs(jobs: List[Dict], options: Dict) -> List[Dict]:
+    # Runs in a pool worker, one job after another, so the in-memory caches of this process (subtitle
+    # rasters, fonts, probes, file digests, keyframe indexes) carry over from job to job.
+    # Imported here, the scheduling process has no use for moviepy.
+    import metrics
+    import test
+
+    results = []
+    for job in jobs:
+        output_dir = Path(job["output_dir"])
+        metrics_file = output_dir / "metrics.json"
+        started = time.perf_counter()
+        metrics.reset()
+        logging.info(f"Starting batch job {job['id']}")
+        try:
+            test.main(
+                job["input_clips"], job["input_video"], job["input_mp3"], job["input_txt"], output_dir,
+                render_mode=job.get("render_mode", options["render_mode"]),
+                workers=job.get("workers", options["job_workers"]),
+                backend=job.get("backend", options["backend"]),
+                segment_cache_dir=options["segment_cache_dir"],
+                segment_cache_bytes=options["segment_cache_bytes"],
+                alignment_cache_dir=options["alignment_cache_dir"],
+                smart_cut=job.get("smart_cut", options["smart_cut"]),
+                status_file=output_dir / "status.json",
+                metrics_file=metrics_file,
+                preview=job.get("preview", options["preview"]),
+                proxy_cache_dir=options["proxy_cache_dir"],
+                targets=job.get("targets", options["targets"])
+            )
+            state, error = "done", None
+        except Exception as e:
+            # One broken job must not stop the batch
+            logging.exception(f"Batch job {job['id']} failed")
+            state, error = "failed", f"{type(e).__name__}: {e}"
+        results.append(job_result(job, state, error, time.perf_counter() - started, metrics.read_report(metrics_file)))
+        logging.info(f"Batch job {job['id']} {state} in {results[-1]['elapsed_seconds']:.1f}s")
+    return results
+
+
+def split_group(jobs: List[Dict], parts: int) -> List[List[Dict]]:
+    if not jobs:
+        return []
+    size = math.ceil(len(jobs) / max(1, parts))
+    return [jobs[start:start + size] for start in range(0, len(jobs), size)]
+
+
+def run_batch(jobs: List[Dict], workers: int, options: Dict) -> List[Dict]:
+    # The first job of every group runs alone and fills the shared caches on disk, the rest of the
+    # group is then spread over the workers in contiguous runs. A pool broken by a dying worker is
+    # replaced, and the tasks it took down are retried once.
+    results = []
+    groups = schedule_groups(jobs)
+    context = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    tasks = {}
+
+    def submit(task_jobs, followers, attempt=1):
+        tasks[pool.submit(run_batch_jobs, task_jobs, options)] = (task_jobs, followers, attempt)
+
+    for group in groups:
+        submit(group[:1], group[1:])
+    try:
+        while tasks:
+            done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # Every task still in the pool fails with it, let them all settle and start a new pool
+                done = wait(tasks)[0]
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            for future in done:
+                task_jobs, followers, attempt = tasks.pop(future)
+                error = future.exception()
+                if error is None:
+                    results += future.result()
+                elif isinstance(error, BrokenProcessPool) and attempt == 1:
+                    logging.warning(f"Render process died, retrying jobs {', '.join(job['id'] for job in task_jobs)}")
+                    submit(task_jobs, followers, attempt + 1)
+                    continue
+                else:
+                    message = "The render process died" if isinstance(error, BrokenProcessPool) else f"{type(error).__name__}: {error}"
+                    results += [job_result(job, "failed", message, None) for job in task_jobs]
+                for chunk in split_group(followers, workers):
+                    submit(chunk, [])
+    finally:
+        pool.shutdown()
+    order = {job["id"]: index for index, job in enumerate(jobs)}
+    return sorted(results, key=lambda result: order[result["id"]])
+
+
+def write_summary(results: List[Dict], elapsed: float, summary_file: Path) -> Dict:
+    finished = [result for result in results if result["elapsed_seconds"] is not None]
+    summary = {
+        "jobs": len(results),
+        "done": sum(1 for result in results if result["state"] == "done"),
+        "failed": sum(1 for result in results if result["state"] == "failed"),
+        "elapsed_seconds": elapsed,
+        "job_seconds": sum(result["elapsed_seconds"] for result in finished),
+        "results": results
+    }
+    summary_file.parent.mkdir(parents=True, exist_ok=True)
+    summary_file.write_text(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Render every job of a JSONL manifest on a pool of workers with shared caches")
+    parser.add_argument("--manifest", "-m", required=True,
+                        help="JSONL file, one job per line with input_clips, input_video, input_mp3, input_txt and output_dir")
+    parser.add_argument("--workers", "-w", type=int, default=os.cpu_count() or 1, help="Jobs rendering at once")
+    parser.add_argument("--job_workers", "-jw", type=int, default=1, help="Render processes of each job")
+    parser.add_argument("--cache_dir", "-cd", default="batch_cache",
+                        help="Directory holding the segment, alignment and proxy caches shared by all jobs")
+    parser.add_argument("--segment_cache_size", "-scs", type=float, default=20.0,
+                        help="Segment cache size limit in GB")
+    parser.add_argument("--render_mode", "-rm", choices=["full", "segments"], default="segments",
+                        help="Render mode of jobs that do not set one")
+    parser.add_argument("--backend", "-b", choices=["moviepy", "ffmpeg"], default="moviepy",
+                        help="Backend of jobs that do not set one")
+    parser.add_argument("--smart_cut", "-sc", action="store_true", help="Smart cut jobs that do not set it")
+    parser.add_argument("--preview", "-p", action="store_true", help="Preview jobs that do not set it")
+    parser.add_argument("--targets", "-t", nargs="+", default=None,
+                        help="Aspect ratios like 9:16 or 9:16@1080x1920 of jobs that do not set targets")
+    parser.add_argument("--summary", "-s", default=None,
+                        help="JSON summary of every job's state and timings, next to the manifest by default")
+
+    args = parser.parse_args()
+    manifest_file = Path(args.manifest)
+    cache_dir = Path(args.cache_dir)
+    options = {
+        "render_mode": args.render_mode,
+        "backend": args.backend,
+        "smart_cut": args.smart_cut,
+        "preview": args.preview,
+        "targets": args.targets,
+        "job_workers": args.job_workers,
+        "segment_cache_dir": cache_dir / "segments",
+        "segment_cache_bytes": int(args.segment_cache_size * 1024 ** 3),
+        "alignment_cache_dir": cache_dir / "alignment",
+        "proxy_cache_dir": cache_dir / "proxies"
+    }
+    jobs = read_manifest(manifest_file)
+    duplicate_ids = sorted(job_id for job_id, count in Counter(job["id"] for job in jobs).items() if count > 1)
+    if duplicate_ids:
+        parser.error(f"Duplicate job ids in {manifest_file}: {', '.join(duplicate_ids)}")
+    logging.info(f"Running {len(jobs)} jobs from {manifest_file} on {args.workers} workers")
+    started = time.perf_counter()
+    results = run_batch(jobs, args.workers, options)
+    summary_file = Path(args.summary) if args.summary else manifest_file.with_name(f"{manifest_file.stem}_summary.json")
+    summary = write_summary(results, time.perf_counter() - started, summary_file)
+    for result in results:
+        timing = f"{result['elapsed_seconds']:.1f}s" if result["elapsed_seconds"] is not None else "-"
+        logging.info(f"{result['id']}: {result['state']} {timing}" + (f" ({result['error']})" if result["error"] else ""))
+    logging.info(
+        f"{summary['done']} of {summary['jobs']} jobs done, {summary['failed']} failed in {summary['elapsed_seconds']:.1f}s; "
+        f"summary written to {summary_file}"
+    )
+    sys.exit(1 if summary["failed"] else 0)
@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from moviepy.config import get_setting
+
+from alignment import ALIGNMENT_TASK_CONFIG, alignment_cache_key
+from ffmpeg_backend import probe_video, run_ffmpeg
+from metrics import read_report
+
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+# Bump when generated inputs change, so stale ones in a work directory are rebuilt
+BENCHMARK_INPUTS_VERSION = 2
+
+# Inputs at several scales: narration length, variations (clips per replacement folder) and clip size
+SCENARIOS = {
+    "30s-2x-720p": {"duration": 30, "variations": 2, "clip_size": (1280, 720)},
+    "30s-10x-720p": {"duration": 30, "variations": 10, "clip_size": (1280, 720)},
+    "30s-50x-720p": {"duration": 30, "variations": 50, "clip_size": (1280, 720)},
+    "30s-2x-4k": {"duration": 30, "variations": 2, "clip_size": (3840, 2160)},
+    "5m-10x-720p": {"duration": 300, "variations": 10, "clip_size": (1280, 720)},
+    "5m-2x-4k": {"duration": 300, "variations": 2, "clip_size": (3840, 2160)},
+}
+
+# Render paths, as test.py arguments; "full" is the reference the others are compared against
+RENDER_PATHS = {
+    "full": ["--render_mode", "full"],
+    "segments": ["--render_mode", "segments"],
+    "smart_cut": ["--render_mode", "segments", "--smart_cut"],
+    "ffmpeg": ["--backend", "ffmpeg"],
+}
+REFERENCE_PATH = "full"
+
+BASE_SIZE = (1080, 1350)
+BASE_FPS = 25
+BASE_KEYFRAME_INTERVAL = 50
+CLIP_FPS = 30
+SUBTITLE_SECONDS = 2.5
+# Replacement folders cover every third subtitle within the first REPLACED_WINDOW seconds
+REPLACED_EVERY = 3
+REPLACED_WINDOW = 30
+
+# Variations of each path compared frame by frame with the reference
+QUALITY_SAMPLE_VARIATIONS = 2
+
+
+def generate_inputs(scenario: Dict, input_dir: Path, alignment_cache_dir: Path) -> Dict:
+    # Deterministic synthetic inputs from lavfi sources; reused while the scenario is unchanged
+    inputs_file = input_dir / "inputs.json"
+    # Through JSON so tuples compare equal to the lists a stored manifest holds
+    manifest = json.loads(json.dumps({"version": BENCHMARK_INPUTS_VERSION, "scenario": scenario}))
+    if inputs_file.exists():
+        inputs = json.loads(inputs_file.read_text())
+        if inputs["manifest"] == manifest:
+            return inputs
+    input_dir.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    duration = scenario["duration"]
+    width, height = BASE_SIZE
+
+    base_video = input_dir / "base.mp4"
+    run_ffmpeg([
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={BASE_FPS}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", BASE_KEYFRAME_INTERVAL, "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-shortest", base_video
+    ])
+    mp3_file = input_dir / "narration.mp3"
+    run_ffmpeg(["-f", "lavfi", "-i", f"sine=frequency=220:sample_rate=44100:duration={duration}", "-c:a", "libmp3lame", mp3_file])
+
+    subtitle_count = int(duration // SUBTITLE_SECONDS)
+    lines = [f"Benchmark subtitle {index + 1} with enough words to wrap onto a second line" for index in range(subtitle_count)]
+    txt_file = input_dir / "narration.txt"
+    txt_file.write_text("\n".join(lines) + "\n")
+    # The alignment a forced aligner would produce, stored in the cache so no aligner is needed
+    fragments = [
+        {"id": f"f{index + 1:06d}", "begin": f"{index * SUBTITLE_SECONDS:.3f}", "end": f"{(index + 1) * SUBTITLE_SECONDS:.3f}",
+         "lines": [line], "language": "eng", "children": []}
+        for index, line in enumerate(lines)
+    ]
+    alignment_cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_key = alignment_cache_key(mp3_file, txt_file, ALIGNMENT_TASK_CONFIG, False)
+    (alignment_cache_dir / f"{cache_key}.json").write_text(json.dumps({"fragments": fragments}))
+
+    clips_dir = input_dir / "clips"
+    clip_width, clip_height = scenario["clip_size"]
+    replaced = [index for index in range(0, subtitle_count, REPLACED_EVERY) if (index + 1) * SUBTITLE_SECONDS <= REPLACED_WINDOW]
+    # Replacements are cut from a clip at the times of the subtitle they replace, so clips span the window
+    clip_duration = min(duration, REPLACED_WINDOW) + 1
+    for index in replaced:
+        folder = clips_dir / str(index + 1)
+        folder.mkdir(parents=True, exist_ok=True)
+        for variation in range(scenario["variations"]):
+            run_ffmpeg([
+                "-f", "lavfi",
+                "-i", f"gradients=size={clip_width}x{clip_height}:rate={CLIP_FPS}:duration={clip_duration}:seed={index * 1000 + variation}",
+                "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", folder / f"clip_{variation + 1:03d}.mp4"
+            ])
+    inputs = {
+        "manifest": manifest,
+        "video": base_video.as_posix(),
+        "mp3": mp3_file.as_posix(),
+        "txt": txt_file.as_posix(),
+        "clips": clips_dir.as_posix(),
+        "replaced_segments": len(replaced)
+    }
+    inputs_file.write_text(json.dumps(inputs))
+    logging.info(f"Generated benchmark inputs in {input_dir} in {time.perf_counter() - started:.1f}s")
+    return inputs
+
+
+def run_render(inputs: Dict, path_args: List[str], output_dir: Path, work_dir: Path, workers: int) -> Dict:
+    # Every render runs in a fresh process so imports, caches and peak memory start from zero
+    metrics_file = output_dir / "metrics.json"
+    command = [
+        sys.executable, (Path(__file__).parent / "test.py").as_posix(),
+        "--input_video", inputs["video"], "--input_clips", inputs["clips"],
+        "--input_mp3", inputs["mp3"], "--input_txt", inputs["txt"], "--output_dir", output_dir.as_posix(),
+        "--alignment_cache_dir", (work_dir / "alignment_cache").as_posix(),
+        "--workers", str(workers), "--metrics_file", metrics_file.as_posix()
+    ] + path_args
+    output_dir.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    with open(output_dir / "render.log", 'wb') as log:
+        result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"Render failed, see {output_dir / 'render.log'}")
+    report = read_report(metrics_file)
+    return {
+        "elapsed_seconds": elapsed,
+        "stages": {name: round(totals["seconds"], 3) for name, totals in report["stages"].items()},
+        "frames_encoded": report["frames_encoded"],
+        "encoding_fps": report["encoding_fps"],
+        "bytes_read": report["bytes_read"],
+        "bytes_written": report["bytes_written"],
+        "peak_rss_bytes": report["peak_rss_bytes"]
+    }
+
+
+def compare_videos(reference_file: Path, output_file: Path, work_dir: Path) -> Dict:
+    # Per-frame PSNR and SSIM of a rendered variation against the reference render of it
+    psnr_log = work_dir / f"{output_file.parent.name}_{output_file.stem}_psnr.log"
+    ssim_log = work_dir / f"{output_file.parent.name}_{output_file.stem}_ssim.log"
+    run_ffmpeg([
+        "-i", output_file, "-i", reference_file, "-lavfi",
+        f"[0:v]split[output_psnr][output_ssim];[1:v]split[reference_psnr][reference_ssim];"
+        f"[output_psnr][reference_psnr]psnr=stats_file={psnr_log.as_posix()};"
+        f"[output_ssim][reference_ssim]ssim=stats_file={ssim_log.as_posix()}",
+        "-f", "null", "-"
+    ])
+    psnr = [float(value) for value in re.findall(r"psnr_avg:(\S+)", psnr_log.read_text())]
+    ssim = [float(value) for value in re.findall(r"All:(\S+)", ssim_log.read_text())]
+    return {
+        "frames": len(psnr),
+        "duration": probe_video(output_file)["video_duration"],
+        "reference_duration": probe_video(reference_file)["video_duration"],
+        "psnr_mean": sum(min(value, 100.0) for value in psnr) / len(psnr),
+        "psnr_min": min(psnr),
+        "ssim_mean": sum(ssim) / len(ssim),
+        "ssim_min": min(ssim)
+    }
+
+
+def check_quality(reference_dir: Path, output_dir: Path, work_dir: Path, variations: int, min_psnr: float, min_ssim: float) -> Dict:
+    comparisons = {}
+    failures = []
+    for variation in range(1, min(variations, QUALITY_SAMPLE_VARIATIONS) + 1):
+        name = f"output_variation_{variation}.mp4"
+        comparison = compare_videos(reference_dir / name, output_dir / name, work_dir)
+        comparisons[name] = comparison
+        if abs(comparison["duration"] - comparison["reference_duration"]) > 1.5 / BASE_FPS:
+            failures.append(f"{name} lasts {comparison['duration']:.2f}s, the reference {comparison['reference_duration']:.2f}s")
+        if comparison["psnr_min"] < min_psnr:
+            failures.append(f"{name} PSNR drops to {comparison['psnr_min']:.1f} dB")
+        if comparison["ssim_min"] < min_ssim:
+            failures.append(f"{name} SSIM drops to {comparison['ssim_min']:.3f}")
+    return {"variations": comparisons, "failures": failures}
+
+
+def compare_with_baseline(results: Dict, baseline: Dict, max_slowdown: float, max_memory_growth: float) -> List[str]:
+    # Only runs present in both are compared; times are checked end to end and per stage
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if result["elapsed_seconds"] > previous["elapsed_seconds"] * (1 + max_slowdown):
+            regressions.append(
+                f"{key}: {result['elapsed_seconds']:.1f}s, baseline {previous['elapsed_seconds']:.1f}s"
+            )
+        for name, seconds in result["stages"].items():
+            previous_seconds = previous["stages"].get(name)
+            # Stages under a second are dominated by noise
+            if previous_seconds and previous_seconds >= 1 and seconds > previous_seconds * (1 + max_slowdown):
+                regressions.append(f"{key} stage {name}: {seconds:.1f}s, baseline {previous_seconds:.1f}s")
+        if result["peak_rss_bytes"] > previous["peak_rss_bytes"] * (1 + max_memory_growth):
+            regressions.append(
+                f"{key}: peak RSS {result['peak_rss_bytes'] / 1024 ** 2:.0f} MB, "
+                f"baseline {previous['peak_rss_bytes'] / 1024 ** 2:.0f} MB"
+            )
+    return regressions
+
+
+def environment() -> Dict:
+    ffmpeg_version = subprocess.run([get_setting("FFMPEG_BINARY"), "-version"], stdout=subprocess.PIPE).stdout.decode('utf-8')
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg_version.splitlines()[0] if ffmpeg_version else None
+    }
+
+
+def run_benchmarks(
+    scenarios: List[str],
+    paths: List[str],
+    work_dir: Path,
+    workers: int,
+    min_psnr: float,
+    min_ssim: float
+) -> Dict:
+    results = {}
+    quality_failures = []
+    for scenario_name in scenarios:
+        scenario = SCENARIOS[scenario_name]
+        inputs = generate_inputs(scenario, work_dir / "inputs" / scenario_name, work_dir / "alignment_cache")
+        # The reference renders first so the other paths can be compared against it
+        for path in sorted(paths, key=lambda path: path != REFERENCE_PATH):
+            key = f"{scenario_name}/{path}"
+            output_dir = work_dir / "outputs" / scenario_name / path
+            logging.info(f"Rendering {key}")
+            result = run_render(inputs, RENDER_PATHS[path], output_dir, work_dir, workers)
+            if path != REFERENCE_PATH and REFERENCE_PATH in paths:
+                result["quality"] = check_quality(
+                    work_dir / "outputs" / scenario_name / REFERENCE_PATH, output_dir, work_dir / "outputs" / scenario_name,
+                    scenario["variations"], min_psnr, min_ssim
+                )
+                quality_failures += [f"{key}: {failure}" for failure in result["quality"]["failures"]]
+            results[key] = result
+            logging.info(
+                f"{key}: {result['elapsed_seconds']:.1f}s, {result['encoding_fps'] or 0:.1f} fps encoding, "
+                f"peak RSS {result['peak_rss_bytes'] / 1024 ** 2:.0f} MB"
+            )
+    return {"environment": environment(), "workers": workers, "results": results, "quality_failures": quality_failures}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the render paths on synthetic inputs")
+    parser.add_argument("--scenarios", "-s", nargs="+", choices=list(SCENARIOS), default=["30s-2x-720p"],
+                        help="Input scales to benchmark")
+    parser.add_argument("--paths", "-p", nargs="+", choices=list(RENDER_PATHS), default=list(RENDER_PATHS),
+                        help="Render paths to benchmark; the others are checked against the full render")
+    parser.add_argument("--work_dir", "-wd", default="benchmark_work",
+                        help="Directory for generated inputs, outputs and caches; inputs are reused across runs")
+    parser.add_argument("--workers", "-w", type=int, default=1, help="Render processes per job")
+    parser.add_argument("--output", "-o", default=None, help="JSON file for the results, work_dir/results.json by default")
+    parser.add_argument("--baseline", "-bl", default="benchmark_baseline.json", help="Results to compare against")
+    parser.add_argument("--save_baseline", "-sb", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--max_slowdown", "-ms", type=float, default=0.15,
+                        help="Allowed fraction of extra time against the baseline, end to end and per stage")
+    parser.add_argument("--max_memory_growth", "-mm", type=float, default=0.2,
+                        help="Allowed fraction of extra peak memory against the baseline")
+    parser.add_argument("--min_psnr", "-mp", type=float, default=35.0, help="Lowest PSNR (dB) of any frame against the reference")
+    parser.add_argument("--min_ssim", "-mss", type=float, default=0.95, help="Lowest SSIM of any frame against the reference")
+
+    args = parser.parse_args()
+    work_dir = Path(args.work_dir)
+    benchmark = run_benchmarks(args.scenarios, args.paths, work_dir, args.workers, args.min_psnr, args.min_ssim)
+    output_file = Path(args.output) if args.output else work_dir / "results.json"
+    output_file.write_text(json.dumps(benchmark, indent=2))
+    logging.info(f"Results written to {output_file}")
+
+    baseline_file = Path(args.baseline)
+    regressions = []
+    if args.save_baseline:
+        baseline = json.loads(baseline_file.read_text())["results"] if baseline_file.exists() else {}
+        baseline.update(benchmark["results"])
+        baseline_file.write_text(json.dumps({"environment": benchmark["environment"], "results": baseline}, indent=2))
+        logging.info(f"Baseline written to {baseline_file}")
+    elif baseline_file.exists():
+        regressions = compare_with_baseline(
+            benchmark["results"], json.loads(baseline_file.read_text())["results"], args.max_slowdown, args.max_memory_growth
+        )
+    else:
+        logging.warning(f"No baseline at {baseline_file}, run with --save_baseline to create one")
+
+    for regression in regressions:
+        logging.error(f"Regression: {regression}")
+    for failure in benchmark["quality_failures"]:
+        logging.error(f"Quality: {failure}")
+    sys.exit(1 if regressions or benchmark["quality_failures"] else 0)
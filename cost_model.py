@@ -0,0 +1,68 @@
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from metrics import read_report
+
+# Until past jobs of a profile calibrate it, a job costs a fixed overhead (alignment lookup, probes,
+# audio, muxing) plus a rate per megapixel it encodes; measured on one core with the medium preset
+DEFAULT_OVERHEAD_SECONDS = 10.0
+DEFAULT_SECONDS_PER_MEGAPIXEL = 0.07
+
+# Newest finished jobs the model is fitted to
+CALIBRATION_JOBS = 50
+
+
+def work_profile(backend: str, render_mode: str, preview: bool) -> str:
+    # Jobs of one profile share a pipeline and a preset, so their rates are fitted together
+    return "/".join([backend, "full" if backend == "ffmpeg" else render_mode] + (["preview"] if preview else []))
+
+
+def fit(samples: List[tuple]) -> Optional[Dict]:
+    # Least squares of elapsed seconds over encoded megapixels. With too few or too similar jobs
+    # for a slope, or a fit that makes no sense, the default overhead is kept and only the rate fitted.
+    samples = [(megapixels, seconds) for megapixels, seconds in samples if megapixels > 0]
+    if not samples:
+        return None
+    count = len(samples)
+    mean_megapixels = sum(megapixels for megapixels, _ in samples) / count
+    mean_seconds = sum(seconds for _, seconds in samples) / count
+    variance = sum((megapixels - mean_megapixels) ** 2 for megapixels, _ in samples)
+    if count >= 2 and variance > 0:
+        rate = sum((megapixels - mean_megapixels) * (seconds - mean_seconds) for megapixels, seconds in samples) / variance
+        overhead = mean_seconds - rate * mean_megapixels
+        if rate > 0 and overhead >= 0:
+            return {"overhead_seconds": overhead, "seconds_per_megapixel": rate, "jobs": count}
+    overhead = min(DEFAULT_OVERHEAD_SECONDS, min(seconds for _, seconds in samples))
+    rate = sum(seconds - overhead for _, seconds in samples) / sum(megapixels for megapixels, _ in samples)
+    return {"overhead_seconds": overhead, "seconds_per_megapixel": rate, "jobs": count}
+
+
+def calibrate(reports: Iterable[Dict]) -> Dict[str, Dict]:
+    # Metrics reports of finished jobs, each carrying the work its plan counted, to a fit per profile
+    samples = {}
+    for report in reports:
+        work = report.get("plan")
+        if work:
+            samples.setdefault(work["profile"], []).append((work["megapixels_encoded"], report["elapsed_seconds"]))
+    calibration = {}
+    for profile, profile_samples in samples.items():
+        fitted = fit(profile_samples[-CALIBRATION_JOBS:])
+        if fitted is not None:
+            calibration[profile] = fitted
+    return calibration
+
+
+def estimate(work: Dict, calibration: Dict[str, Dict]) -> Dict:
+    model = calibration.get(work["profile"]) or {
+        "overhead_seconds": DEFAULT_OVERHEAD_SECONDS, "seconds_per_megapixel": DEFAULT_SECONDS_PER_MEGAPIXEL, "jobs": 0
+    }
+    return dict(model, seconds=model["overhead_seconds"] + model["seconds_per_megapixel"] * work["megapixels_encoded"])
+
+
+def read_history(history_dir: Path, limit: int = CALIBRATION_JOBS) -> List[Dict]:
+    # Metrics reports under history_dir whose jobs were planned, oldest first
+    report_files = sorted(Path(history_dir).glob("**/metrics.json"), key=lambda file: file.stat().st_mtime)
+    reports = [report for report in map(read_report, report_files) if report and report.get("plan")]
+    logging.info(f"Calibrating render estimates from {len(reports[-limit:])} past jobs in {history_dir}")
+    return reports[-limit:]
@@ -0,0 +1,190 @@
+import logging
+import math
+import subprocess
+from functools import lru_cache
+from logging import debug
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from PIL import Image
+
+from subtitle_renderer import render_subtitle_overlay, subtitle_overlay_to_rgba
+
+
+def run_ffmpeg(args: List[str]) -> None:
+    command = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error"] + [str(arg) for arg in args]
+    debug(f"Running ffmpeg: {' '.join(command)}")
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {result.returncode}: {result.stderr.decode('utf-8')}")
+
+
+def encode_audio(source_file: Path, duration: float, output_file: Path, audio_codec: str) -> Path:
+    run_ffmpeg([
+        "-i", source_file, "-vn", "-map", "0:a:0", "-t", f"{duration:.6f}",
+        "-c:a", audio_codec, "-ar", "44100", output_file
+    ])
+    return output_file
+
+
+def mux_audio(video_file: Path, audio_file: Optional[Path], output_file: Path) -> Path:
+    # Both streams are copied, the video and the job's audio are encoded exactly once
+    input_args = ["-i", video_file] + (["-i", audio_file] if audio_file else [])
+    map_args = ["-map", "0:v:0"] + (["-map", "1:a:0"] if audio_file else [])
+    run_ffmpeg(input_args + map_args + ["-c", "copy", "-movflags", "+faststart", output_file])
+    return output_file
+
+
+@lru_cache(maxsize=None)
+def probe_video(file: Path) -> Dict:
+    # Container metadata only, no frame is decoded
+    if not file.exists():
+        raise FileNotFoundError(f"Video file not found: {file}")
+    return ffmpeg_parse_infos(file.as_posix())
+
+
+def write_subtitle_overlay(subtitle: Dict, output_file: Path) -> Path:
+    overlay = render_subtitle_overlay(
+        subtitle["text"],
+        subtitle["font"],
+        subtitle["font_size"],
+        subtitle["color"],
+        subtitle["width"],
+        subtitle["margin"],
+        box_color=tuple(subtitle["box_color"]),
+        box_opacity=subtitle["box_opacity"],
+        stroke_color=subtitle["stroke_color"],
+        stroke_width=subtitle["stroke_width"]
+    )
+    Image.fromarray(subtitle_overlay_to_rgba(overlay), "RGBA").save(output_file)
+    return output_file
+
+
+def segment_filter(input_label: str, segment: Dict, fps: float, trim_input: bool) -> str:
+    # Trim, loop and fit one planned segment, mirroring adjust_segment_duration and adjust_segment_properties
+    filters = []
+    source_duration = segment["end"] - segment["start"]
+    used_duration = min(source_duration, segment["duration"])
+    if trim_input:
+        filters += [f"trim=start={segment['start']:.6f}:end={segment['start'] + used_duration:.6f}", "setpts=PTS-STARTPTS"]
+    if segment.get("crop"):
+        x1, y1, x2, y2 = segment["crop"]
+        filters.append(f"crop={x2 - x1}:{y2 - y1}:{x1}:{y1}")
+    filters.append(f"fps={fps}")
+    if source_duration < segment["duration"]:
+        loop_size = math.ceil(source_duration * fps)
+        filters.append(f"loop=loop=-1:size={loop_size}:start=0")
+    filters += [f"trim=duration={segment['duration']:.6f}", "setpts=PTS-STARTPTS"]
+    if segment.get("size"):
+        width, height = segment["size"]
+        filters.append(f"scale={width}:{height}")
+    filters.append("setsar=1")
+    return f"[{input_label}]{','.join(filters)}"
+
+
+def build_filtergraph(
+    segments: List[Dict], base_file: Path, fps: float, work_dir: Path, targets: Optional[List[Dict]] = None
+) -> (List[str], str):
+    # Returns the ffmpeg input arguments and a filter_complex that renders the whole variation to [video],
+    # or to [video0], [video1]... cut from it for each of the targets, with the subtitles they lay out.
+    # The base video is input 0 and is split once, every other source and overlay gets its own input.
+    input_args = ["-i", base_file]
+    input_count = 1
+    base_segments = [index for index, segment in enumerate(segments) if Path(segment["source"]) == base_file]
+    graph = []
+    if base_segments:
+        outputs = "".join(f"[base{index}]" for index in base_segments)
+        graph.append(f"[0:v]split={len(base_segments)}{outputs}")
+
+    for index, segment in enumerate(segments):
+        if index in base_segments:
+            chain = segment_filter(f"base{index}", segment, fps, trim_input=True)
+        else:
+            # Input seeking keeps the decoder away from footage this segment does not use
+            input_args += [
+                "-ss", f"{segment['start']:.6f}", "-t", f"{segment['end'] - segment['start']:.6f}",
+                "-i", segment["source"]
+            ]
+            chain = segment_filter(f"{input_count}:v", segment, fps, trim_input=False)
+            input_count += 1
+        subtitle = segment.get("subtitle") if not targets else None
+        if subtitle:
+            overlay_file = write_subtitle_overlay(subtitle, work_dir / f"subtitle_{index:04d}.png")
+            input_args += ["-i", overlay_file]
+            margin = subtitle["margin"]
+            graph.append(f"{chain}[plain{index}]")
+            chain = (
+                f"[plain{index}][{input_count}:v]overlay=x={margin}:y=main_h-overlay_h-{margin}"
+                f":enable='lt(t,{subtitle['duration']:.6f})':eof_action=repeat"
+            )
+            input_count += 1
+        graph.append(f"{chain}[segment{index}]")
+
+    concat_inputs = "".join(f"[segment{index}]" for index in range(len(segments)))
+    if not targets:
+        graph.append(f"{concat_inputs}concat=n={len(segments)}:v=1:a=0,format=yuv420p[video]")
+        return input_args, ";\n".join(graph)
+
+    # The composed stream is split once more, every target crops and scales its copy and draws its own subtitles
+    composed = "".join(f"[composed{target_index}]" for target_index in range(len(targets)))
+    graph.append(f"{concat_inputs}concat=n={len(segments)}:v=1:a=0,split={len(targets)}{composed}")
+    for target_index, target in enumerate(targets):
+        x1, y1, x2, y2 = target["crop"]
+        width, height = target["size"]
+        chain = f"[composed{target_index}]crop={x2 - x1}:{y2 - y1}:{x1}:{y1},scale={width}:{height},setsar=1"
+        start = 0.0
+        for index, segment in enumerate(segments):
+            subtitle = segment.get("target_subtitles", {}).get(target["name"])
+            if subtitle:
+                overlay_file = write_subtitle_overlay(subtitle, work_dir / f"subtitle_{index:04d}_{target['name']}.png")
+                input_args += ["-i", overlay_file]
+                margin = subtitle["margin"]
+                end = start + min(subtitle["duration"], segment["duration"])
+                graph.append(f"{chain}[target{target_index}_{index}]")
+                chain = (
+                    f"[target{target_index}_{index}][{input_count}:v]overlay=x={margin}:y=main_h-overlay_h-{margin}"
+                    f":enable='gte(t,{start:.6f})*lt(t,{end:.6f})':eof_action=repeat"
+                )
+                input_count += 1
+            start += segment["duration"]
+        graph.append(f"{chain},format=yuv420p[video{target_index}]")
+    return input_args, ";\n".join(graph)
+
+
+def render_variation(
+    segments: List[Dict],
+    base_file: Path,
+    output_file: Path,
+    work_dir: Path,
+    video_codec: str,
+    audio_file: Optional[Path] = None,
+    threads: Optional[int] = None,
+    video_preset: str = "medium",
+    targets: Optional[List[Dict]] = None
+) -> Path:
+    # With targets, each target dict also names the file it is written to, and output_file only names
+    # the filtergraph; all targets are encoded side by side from the one decode
+    fps = probe_video(base_file)["video_fps"]
+    duration = sum(segment["duration"] for segment in segments)
+    input_args, filtergraph = build_filtergraph(segments, base_file, fps, work_dir, targets)
+    filtergraph_file = work_dir / f"{output_file.stem}_filtergraph.txt"
+    filtergraph_file.write_text(filtergraph)
+    audio_args = []
+    if audio_file:
+        # The job's audio is already encoded, it is only copied into the output
+        audio_args = ["-map", f"{input_args.count('-i')}:a:0", "-c:a", "copy"]
+        input_args = input_args + ["-i", audio_file]
+    thread_args = ["-threads", threads] if threads else []
+    outputs = [(f"[video{index}]", target["file"]) for index, target in enumerate(targets)] if targets else [("[video]", output_file)]
+    output_args = []
+    for label, file in outputs:
+        output_args += [
+            # Pinned, the overlay images would otherwise set the output frame rate
+            "-map", label, "-r", fps, "-t", f"{duration:.6f}",
+            "-c:v", video_codec, "-preset", video_preset
+        ] + audio_args + thread_args + ["-movflags", "+faststart", file]
+    run_ffmpeg(input_args + ["-filter_complex_script", filtergraph_file] + output_args)
+    logging.info(f"Rendered {', '.join(str(file) for _, file in outputs)} with a single ffmpeg filtergraph")
+    return output_file
@@ -0,0 +1,179 @@
+import warnings
+from collections import OrderedDict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+# Buffers in each ring: the frame handed out last stays intact while the next one is filled
+FRAME_RING_SIZE = 2
+
+
+class FrameBufferPool:
+    # A fixed ring of frame-sized arrays handed out in turn. A buffer is written again FRAME_RING_SIZE
+    # hand-outs later, so a frame must be consumed (encoded, copied) before then, as in a render loop.
+
+    def __init__(self, shape: Tuple[int, ...], count: int = FRAME_RING_SIZE):
+        self.buffers = [np.empty(shape, dtype=np.uint8) for _ in range(count)]
+        self.position = 0
+
+    def upcoming(self) -> np.ndarray:
+        return self.buffers[self.position]
+
+    def next(self) -> np.ndarray:
+        buffer = self.buffers[self.position]
+        self.position = (self.position + 1) % len(self.buffers)
+        return buffer
+
+    def copy(self, frame: np.ndarray) -> np.ndarray:
+        buffer = self.next()
+        np.copyto(buffer, frame)
+        return buffer
+
+
+# Rings shared by everything in this process that needs a private copy of a frame, by frame shape
+shared_pools: Dict[Tuple[int, ...], FrameBufferPool] = {}
+
+
+def shared_pool(shape: Tuple[int, ...]) -> FrameBufferPool:
+    if shape not in shared_pools:
+        shared_pools[shape] = FrameBufferPool(shape)
+    return shared_pools[shape]
+
+
+class FrameCache:
+    # Private copies of decoded frames by key, at most max_bytes of them, least recently used dropped
+    # first. Cached frames are read-only, whoever draws on one draws on a copy.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key) -> Optional[np.ndarray]:
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame: np.ndarray) -> np.ndarray:
+        if frame.nbytes > self.max_bytes:
+            return frame
+        frame = frame.copy()
+        frame.flags.writeable = False
+        if key in self.frames:
+            self.bytes -= self.frames.pop(key).nbytes
+        self.frames[key] = frame
+        self.bytes += frame.nbytes
+        while self.bytes > self.max_bytes:
+            self.bytes -= self.frames.popitem(last=False)[1].nbytes
+        return frame
+
+
+class PooledVideoReader(FFMPEG_VideoReader):
+    # FFMPEG_VideoReader that reads every frame from the decoder's pipe straight into a ring of
+    # preallocated arrays, instead of a new bytes object and array per frame. The pipe is
+    # unbuffered, so frames are not staged in a frame-sized read buffer either.
+
+    def __init__(self, filename: str, **kwargs):
+        self.frames = None
+        FFMPEG_VideoReader.__init__(self, filename, bufsize=0, **kwargs)
+
+    def read_into(self, buffer: np.ndarray) -> int:
+        view = memoryview(buffer).cast('B')
+        received = 0
+        while received < len(view):
+            read = self.proc.stdout.readinto(view[received:])
+            if not read:
+                break
+            received += read
+        return received
+
+    def skip_frames(self, n=1):
+        # Skipped frames land in the buffer the next read overwrites anyway
+        for _ in range(n):
+            self.read_into(self.ring().upcoming())
+        self.pos += n
+
+    def ring(self) -> FrameBufferPool:
+        if self.frames is None:
+            width, height = self.size
+            self.frames = FrameBufferPool((height, width, self.depth))
+        return self.frames
+
+    def read_frame(self):
+        # The ring only moves on once a whole frame is in, a short read never touches the last frame
+        frame = self.ring().upcoming()
+        received = self.read_into(frame)
+        if received != frame.nbytes:
+            warnings.warn(
+                f"In file {self.filename}, {frame.nbytes} bytes wanted but {received} bytes read at frame "
+                f"{self.pos}/{self.nframes}, using the last valid frame instead.", UserWarning
+            )
+            if not hasattr(self, 'lastread'):
+                raise IOError(f"Failed to read the first frame of video file {self.filename}")
+            return self.lastread
+        self.lastread = self.ring().next()
+        return frame
+
+
+def write_frame(writer: FFMPEG_VideoWriter, frame: np.ndarray, output_file: Path) -> None:
+    # Frames that are not contiguous, like crops, are first copied into a reused buffer
+    if not frame.flags.c_contiguous:
+        frame = shared_pool(frame.shape).copy(frame)
+    try:
+        writer.proc.stdin.write(memoryview(frame))
+    except IOError as e:
+        _, ffmpeg_error = writer.proc.communicate()
+        raise IOError(f"{e}\n\nffmpeg failed while writing {output_file}:\n{ffmpeg_error.decode('utf-8', 'replace')}")
+
+
+def write_video_frames(
+    clip,
+    output_file: Path,
+    fps: float,
+    codec: str,
+    preset: str,
+    threads: Optional[int] = None,
+    logger=None
+) -> int:
+    # write_videofile without audio, except that frames reach the encoder's stdin as memoryviews of
+    # their arrays rather than copies made by tobytes(). Returns the number of frames written.
+    frames_written = 0
+    with FFMPEG_VideoWriter(Path(output_file).as_posix(), clip.size, fps, codec=codec, preset=preset, threads=threads) as writer:
+        for frame in clip.iter_frames(fps=fps, dtype="uint8", logger=logger):
+            write_frame(writer, frame, output_file)
+            frames_written += 1
+    return frames_written
+
+
+def write_target_frames(
+    clip,
+    outputs: List[Dict],
+    fps: float,
+    codec: str,
+    preset: str,
+    threads: Optional[int] = None,
+    logger=None
+) -> int:
+    # write_video_frames for several outputs made from the same frames: each frame of clip is decoded
+    # and composed once, and every output's compose(frame, t) turns it into a frame of the output's
+    # size for its own encoder, which scales it to the output's scale when one is given. The encoders
+    # are separate ffmpeg processes and run in parallel. Returns the number of frames written to each output.
+    frames_written = 0
+    with ExitStack() as stack:
+        writers = []
+        for output in outputs:
+            scale = output.get("scale")
+            scale_params = ["-vf", f"scale={scale[0]}:{scale[1]}"] if scale and tuple(scale) != tuple(output["size"]) else None
+            writers.append(stack.enter_context(FFMPEG_VideoWriter(
+                Path(output["file"]).as_posix(), output["size"], fps, codec=codec, preset=preset, threads=threads, ffmpeg_params=scale_params
+            )))
+        for t, frame in clip.iter_frames(fps=fps, with_times=True, dtype="uint8", logger=logger):
+            for output, writer in zip(outputs, writers):
+                write_frame(writer, output["compose"](frame, t), output["file"])
+            frames_written += 1
+    return frames_written
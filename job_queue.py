@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import cost_model
+from metrics import JobMetrics, read_report
+from render_worker import RENDER_WORKER_MAX_JOBS, RENDER_WORKER_MAX_RSS_BYTES, RenderWorker
+
+# Uploads without a new chunk for this long no longer hold a place in the queue, and are dropped
+# with their partial files by the next expire_uploads
+UPLOAD_IDLE_TIMEOUT = 60 * 60
+
+class JobStatus:
+    # State of one render job, written atomically to a JSON file the web queue reads when polled.
+    # Without a status file every update is kept in memory only.
+
+    def __init__(self, status_file: Optional[Path] = None):
+        self.status_file = Path(status_file) if status_file else None
+        self.status = {"state": "queued", "variations": {}}
+
+    def update(self, **fields) -> None:
+        self.status.update(fields)
+        self.status["updated"] = time.time()
+        if self.status_file is None:
+            return
+        temporary_file = self.status_file.with_name(f".{self.status_file.name}.{uuid.uuid4().hex}")
+        with open(temporary_file, 'w') as f:
+            json.dump(self.status, f)
+        os.replace(temporary_file, self.status_file)
+
+    def start_rendering(self, output_files: List[Path]) -> None:
+        self.update(state="rendering", variations={Path(output_file).name: "rendering" for output_file in output_files})
+
+    def variation_done(self, output_file: Path) -> None:
+        self.status["variations"][Path(output_file).name] = "done"
+        self.update()
+
+
+def read_job_status(status_file: Path) -> Dict:
+    try:
+        with open(status_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    # Render jobs run on a fixed number of worker threads, each handing its jobs to a warm render
+    # process of its own that is replaced after worker_max_jobs jobs or past worker_max_rss_bytes.
+    # Jobs beyond max_queued waiting ones, counting those still uploading, are refused instead of
+    # piling up behind the workers. A job may name processes it needs finished before it starts.
+    # Every submitted job is planned by a dry run on a warm process of its own, which does not align
+    # and takes a moment. The workers take the planned job with the shortest estimate, less the time
+    # it has waited so a long job is not passed over forever, and the oldest unplanned one when no
+    # planned job is waiting. The estimates are calibrated from the metrics of finished jobs, and
+    # those of past runs under history_dir.
+
+    def __init__(
+        self,
+        workers: int,
+        max_queued: int,
+        worker_max_jobs: int = RENDER_WORKER_MAX_JOBS,
+        worker_max_rss_bytes: int = RENDER_WORKER_MAX_RSS_BYTES,
+        history_dir: Optional[Path] = None
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.planning = queue.Queue()
+        self.metrics = JobMetrics()
+        self.reports = deque(cost_model.read_history(history_dir) if history_dir and Path(history_dir).exists() else [],
+                             maxlen=cost_model.CALIBRATION_JOBS)
+        self.calibration = cost_model.calibrate(self.reports)
+        threading.Thread(target=self.plan, args=(RenderWorker(worker_max_jobs, worker_max_rss_bytes),), daemon=True).start()
+        for _ in range(workers):
+            threading.Thread(target=self.work, args=(RenderWorker(worker_max_jobs, worker_max_rss_bytes),), daemon=True).start()
+
+    def queued(self) -> int:
+        idle_since = time.time() - UPLOAD_IDLE_TIMEOUT
+        return sum(
+            1 for job in self.jobs.values()
+            if job["state"] == "queued" or (job["state"] == "uploading" and job["updated"] > idle_since)
+        )
+
+    def accepting(self) -> bool:
+        with self.lock:
+            return self.queued() < self.max_queued
+
+    def register(
+        self, job_id: str, output_dir: Path, input_dir: Optional[Path] = None, state: str = "uploading", arguments: Optional[Dict] = None
+    ) -> Dict:
+        # Every field schedule() reads is set here, so a job is never queued without its arguments and time
+        with self.lock:
+            queued = self.queued()
+            if queued >= self.max_queued:
+                raise QueueFull(f"{queued} jobs are already waiting")
+            job = {
+                "id": job_id,
+                "state": state,
+                "arguments": arguments,
+                "prerequisites": [],
+                "output_dir": Path(output_dir),
+                "input_dir": Path(input_dir) if input_dir else None,
+                "status_file": Path(output_dir) / "status.json",
+                "log_file": Path(output_dir) / "job.log",
+                "metrics_file": Path(output_dir) / "metrics.json",
+                "plan_file": Path(output_dir) / "plan.json",
+                "planned": False,
+                "work": None,
+                "created": time.time(),
+                "updated": time.time(),
+                "submitted": time.time(),
+                "error": None
+            }
+            self.jobs[job_id] = job
+        return job
+
+    def submit(self, job_id: str, arguments: Dict, output_dir: Path, input_dir: Optional[Path] = None) -> Dict:
+        # arguments are test.main's keyword arguments. Jobs registered while uploading keep their
+        # place, others are registered here
+        job = self.jobs.get(job_id) or self.register(job_id, output_dir, input_dir, state="queued", arguments=arguments)
+        with self.ready:
+            job["arguments"] = arguments
+            job["submitted"] = time.time()
+            job["state"] = "queued"
+            self.ready.notify()
+        self.planning.put(job_id)
+        return job
+
+    def touch(self, job_id: str) -> None:
+        # A chunk racing expire_uploads finds its job gone, the upload is dropped either way
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job["updated"] = time.time()
+
+    def expire_uploads(self) -> List[str]:
+        # Uploads idle for longer than UPLOAD_IDLE_TIMEOUT are given up: the job is dropped, the
+        # alignment started for it is stopped and its partial files removed. Returns their job ids.
+        idle_since = time.time() - UPLOAD_IDLE_TIMEOUT
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job["state"] == "uploading" and job["updated"] <= idle_since]
+            for job in expired:
+                del self.jobs[job["id"]]
+        for job in expired:
+            for process in job["prerequisites"]:
+                process.kill()
+                process.wait()
+            if job["input_dir"] is not None:
+                shutil.rmtree(job["input_dir"], ignore_errors=True)
+            logging.info(f"Dropped job {job['id']}, its upload was idle for over {UPLOAD_IDLE_TIMEOUT}s")
+        return [job["id"] for job in expired]
+
+    def add_prerequisite(self, job_id: str, process: subprocess.Popen) -> None:
+        self.jobs[job_id]["prerequisites"].append(process)
+
+    def estimate(self, job: Dict) -> Optional[float]:
+        return cost_model.estimate(job["work"], self.calibration)["seconds"] if job["work"] else None
+
+    def schedule_key(self, job: Dict, now: float) -> float:
+        # A job that could not be planned counts as free, its inputs most likely fail it fast
+        return (self.estimate(job) or 0.0) - (now - job["submitted"])
+
+    def schedule(self) -> List[Dict]:
+        # Queued jobs in the order the workers will take them, those still planning last in the order
+        # they came; under the lock
+        now = time.time()
+        queued = [job for job in self.jobs.values() if job["state"] == "queued"]
+        return sorted(queued, key=lambda job: (0, self.schedule_key(job, now)) if job["planned"] else (1, job["submitted"]))
+
+    def plan(self, planner: RenderWorker) -> None:
+        while True:
+            try:
+                planner.start()
+            except Exception:
+                logging.exception("Could not start the planning worker")
+            job = self.jobs[self.planning.get()]
+            try:
+                # Planned even once started, the estimate still gives its ETA
+                arguments = dict(job["arguments"], dry_run=True, plan_file=job["plan_file"].as_posix())
+                result = planner.run(arguments, job["output_dir"] / "plan.log")
+                if result["state"] == "done":
+                    job["work"] = read_report(job["plan_file"])["work"]
+                    logging.info(f"Planned job {job['id']}, estimated {self.estimate(job):.0f}s")
+                else:
+                    logging.warning(f"Could not plan job {job['id']}: {result['error']}")
+            except Exception:
+                logging.exception(f"Could not plan job {job['id']}")
+            finally:
+                with self.ready:
+                    job["planned"] = True
+                    self.ready.notify()
+
+    def work(self, worker: RenderWorker) -> None:
+        while True:
+            # Started before the job arrives, so a job never waits for the imports
+            try:
+                worker.start()
+            except Exception:
+                logging.exception("Could not start a render worker")
+            with self.ready:
+                while not self.schedule():
+                    self.ready.wait()
+                job = self.schedule()[0]
+                job["state"] = "aligning"
+                job["started"] = time.time()
+            logging.info(f"Starting job {job['id']}")
+            try:
+                for process in job["prerequisites"]:
+                    process.wait()
+                job["output_dir"].mkdir(parents=True, exist_ok=True)
+                result = worker.run(job["arguments"], job["log_file"])
+                if result["state"] != "done":
+                    log_tail = job["log_file"].read_bytes()[-2000:].decode('utf-8', 'replace') if job["log_file"].exists() else ""
+                    job["error"] = log_tail or result["error"]
+                job["state"] = result["state"]
+            except Exception as e:
+                job["error"] = str(e)
+                job["state"] = "failed"
+            finally:
+                job["finished"] = time.time()
+                report = read_report(job["metrics_file"])
+                self.metrics.add(job["state"], report)
+                if job["state"] == "done" and report and report.get("plan"):
+                    with self.lock:
+                        self.reports.append(report)
+                        self.calibration = cost_model.calibrate(self.reports)
+                # The uploads are only needed while rendering, the outputs stay until removed
+                if job["input_dir"] is not None:
+                    shutil.rmtree(job["input_dir"], ignore_errors=True)
+                logging.info(f"Job {job['id']} {job['state']}")
+
+    def eta(self, job_id: str) -> Optional[float]:
+        # Seconds until the job is done: what is left of the running jobs' estimates, then the queued
+        # jobs ahead of it in schedule order, spread over the workers as they free up
+        with self.lock:
+            job = self.jobs[job_id]
+            now = time.time()
+            if job["state"] in ("done", "failed", "uploading") or job["work"] is None:
+                return None
+            if job["state"] != "queued":
+                return max(0.0, self.estimate(job) - (now - job["started"]))
+            running = [
+                max(0.0, (self.estimate(other) or 0.0) - (now - other["started"]))
+                for other in self.jobs.values() if other["state"] not in ("uploading", "queued", "done", "failed")
+            ]
+            free = sorted(running + [0.0] * max(0, self.workers - len(running)))[:self.workers]
+            for other in self.schedule():
+                start = free.pop(0)
+                finish = start + (self.estimate(other) or 0.0)
+                if other is job:
+                    return finish
+                free = sorted(free + [finish])
+            return None
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        reported = read_job_status(job["status_file"]) if job["state"] != "queued" else {}
+        state = job["state"]
+        if state == "aligning" and reported.get("state") in ("aligning", "rendering"):
+            # Running, the pipeline itself knows which stage it is in
+            state = reported["state"]
+        variations = reported.get("variations", {})
+        return {
+            "id": job_id,
+            "state": state,
+            "position": self.position(job_id),
+            "variations": variations,
+            "variations_done": sum(1 for variation_state in variations.values() if variation_state == "done"),
+            "variations_total": len(variations),
+            "files": sorted(name for name, variation_state in variations.items() if variation_state == "done"),
+            "estimated_seconds": self.estimate(job),
+            "eta_seconds": self.eta(job_id),
+            "error": job["error"]
+        }
+
+    def prometheus_text(self) -> str:
+        with self.lock:
+            states = {state: 0 for state in ("uploading", "queued", "running")}
+            for job in self.jobs.values():
+                if job["state"] in ("uploading", "queued"):
+                    states[job["state"]] += 1
+                elif job["state"] not in ("done", "failed"):
+                    states["running"] += 1
+        return self.metrics.prometheus_text(states)
+
+    def position(self, job_id: str) -> Optional[int]:
+        # Jobs waiting ahead of this one in schedule order, None once it has started
+        with self.lock:
+            job = self.jobs[job_id]
+            if job["state"] != "queued":
+                return None
+            return [other["id"] for other in self.schedule()].index(job_id)
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import uuid
+from fractions import Fraction
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from moviepy.config import get_setting
+
+from ffmpeg_backend import run_ffmpeg
+from segment_cache import file_digest
+
+# Bump when the layout of a stored index changes
+KEYFRAME_INDEX_VERSION = 2
+
+# Parameter sets in the extradata are the headings trace_headers prints before the first packet
+PARAMETER_SET_SECTIONS = ("Sequence Parameter Set", "Picture Parameter Set")
+
+
+def read_parameter_sets(file: Path) -> List[str]:
+    # The SPS and PPS of the first video stream's extradata, one "field=value" per syntax element,
+    # as the trace_headers bitstream filter prints them. The VUI's display and timing hints are left
+    # out, a decoder does not need them; its bitstream restrictions (reorder depth, DPB size) stay in.
+    command = [
+        get_setting("FFMPEG_BINARY"), "-hide_banner", "-i", Path(file).as_posix(),
+        "-map", "0:v:0", "-c", "copy", "-bsf:v", "trace_headers", "-frames:v", "1", "-f", "null", "-"
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not read the parameter sets of {file}: {result.stderr.decode('utf-8')}")
+    fields = []
+    section = None
+    in_vui = False
+    for line in result.stderr.decode('utf-8').splitlines():
+        match = re.match(r"\[trace_headers @ [^\]]+\] (.*)", line)
+        if match is None:
+            continue
+        field = re.match(r"\d+\s+(\w+)\s+[01]+ = (-?\d+)", match.group(1))
+        if field is None:
+            if match.group(1).startswith("Packet:"):
+                break
+            section = match.group(1).strip()
+            continue
+        name, value = field.groups()
+        if section not in PARAMETER_SET_SECTIONS:
+            continue
+        if name == "bitstream_restriction_flag":
+            in_vui = False
+        if not in_vui:
+            fields.append(f"{name}={value}")
+        if name == "vui_parameters_present_flag":
+            in_vui = True
+    return fields
+
+
+def read_packet_index(file: Path) -> Dict:
+    # The framecrc muxer lists every packet of the first video stream with its timestamps and
+    # flags, the same packet table ffprobe -show_packets gives, without decoding a single frame.
+    # ffmpeg is used because ffprobe does not ship with imageio-ffmpeg.
+    command = [
+        get_setting("FFMPEG_BINARY"), "-hide_banner", "-i", Path(file).as_posix(),
+        "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not index {file}: {result.stderr.decode('utf-8')}")
+    stream_info = re.search(r"Stream #0:\d+.*?: Video: (\w+)[^,]*, (\w+)", result.stderr.decode('utf-8'))
+    time_base = Fraction(1)
+    packets = []
+    for line in result.stdout.decode('utf-8').splitlines():
+        if line.startswith("#tb 0:"):
+            time_base = Fraction(line.split(":", 1)[1].strip())
+        elif line and not line.startswith("#"):
+            fields = [field.strip() for field in line.split(",")]
+            # Packets without an F= field carry the default flags, which is the keyframe flag alone
+            flags = int(fields[6][2:], 16) if len(fields) > 6 else 1
+            packets.append((int(fields[2]), bool(flags & 1)))
+    packets.sort()
+    return {
+        "version": KEYFRAME_INDEX_VERSION,
+        "codec": stream_info.group(1) if stream_info else None,
+        "pix_fmt": stream_info.group(2) if stream_info else None,
+        "frame_times": [float(pts * time_base) for pts, _ in packets],
+        "keyframes": [frame for frame, (_, key) in enumerate(packets) if key],
+        "parameter_sets": read_parameter_sets(file)
+    }
+
+
+@lru_cache(maxsize=None)
+def _keyframe_index(file: str, digest: str, cache_dir: Optional[str]) -> Dict:
+    cache_file = Path(cache_dir) / f"{digest}.keyframes.json" if cache_dir else None
+    if cache_file is not None and cache_file.exists():
+        with open(cache_file, 'r') as f:
+            index = json.load(f)
+        if index.get("version") == KEYFRAME_INDEX_VERSION:
+            return index
+    index = read_packet_index(Path(file))
+    logging.info(f"Indexed {len(index['frame_times'])} frames, {len(index['keyframes'])} keyframes of {file}")
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temporary_file = cache_file.with_name(f".{cache_file.name}.{uuid.uuid4().hex}")
+        with open(temporary_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary_file, cache_file)
+    return index
+
+
+def keyframe_index(file: Path, cache_dir: Optional[Path] = None) -> Dict:
+    # Built once per file content, kept in memory and, given a cache_dir, on disk across jobs
+    return _keyframe_index(Path(file).resolve().as_posix(), file_digest(Path(file)), str(cache_dir) if cache_dir else None)
+
+
+def stream_copy_compatible(index: Dict, fps: float, codec: str, pix_fmt: str, parameter_sets: List[str]) -> bool:
+    # Copied packets are joined with freshly encoded ones and decoded with the encoder's extradata,
+    # so the stream must already be in the output codec and pixel format, carry the same SPS and PPS
+    # (profile, level, entropy coder, reference and reorder depth), and frame k must play at k / fps
+    # like moviepy assumes
+    if index["codec"] != codec or index["pix_fmt"] != pix_fmt or index["parameter_sets"] != parameter_sets:
+        return False
+    return all(abs(time - frame / fps) < 0.5 / fps for frame, time in enumerate(index["frame_times"]))
+
+
+def stream_copy_range(index: Dict, start_frame: int, end_frame: int) -> Optional[Tuple[int, int]]:
+    # The longest run of whole GOPs inside [start_frame, end_frame): it starts on a keyframe and
+    # ends on the next keyframe or the end of the stream, so no copied frame references a cut one
+    boundaries = index["keyframes"] + [len(index["frame_times"])]
+    copy_start = next((frame for frame in boundaries if frame >= start_frame), None)
+    copy_end = next((frame for frame in reversed(boundaries) if frame <= end_frame), None)
+    if copy_start is None or copy_end is None or copy_start >= copy_end:
+        return None
+    return copy_start, copy_end
+
+
+def copy_frames(file: Path, index: Dict, start_frame: int, end_frame: int, output_file: Path) -> Path:
+    # Seeking lands on the keyframe at start_frame (the target sits a little past it to survive
+    # rounding), stream copy keeps every packet from there and -frames:v stops before end_frame
+    frame_times = index["frame_times"]
+    next_time = frame_times[start_frame + 1] if start_frame + 1 < len(frame_times) else frame_times[start_frame]
+    seek_time = (frame_times[start_frame] + next_time) / 2
+    run_ffmpeg([
+        "-ss", f"{seek_time:.6f}", "-i", file, "-map", "0:v:0", "-c", "copy",
+        "-frames:v", end_frame - start_frame, "-avoid_negative_ts", "make_zero", output_file
+    ])
+    return output_file
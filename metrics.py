@@ -0,0 +1,214 @@
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+# Stages: alignment, video_load, segmentation, replacement_load, subtitle_render, compositing,
+# encoding, audio_encoding, stream_copy and muxing. Stages nest, encoding includes the decoding
+# and compositing done for the frames it encodes.
+
+# Measurements of this process since the last reset, render workers hand theirs back with each task
+recorded = {"stages": defaultdict(lambda: {"seconds": 0.0, "calls": 0}), "counters": defaultdict(int), "peak_rss_bytes": 0}
+
+# How often resident memory is sampled while a job runs
+RSS_SAMPLE_SECONDS = 0.5
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        totals = recorded["stages"][name]
+        totals["seconds"] += time.perf_counter() - started
+        totals["calls"] += 1
+
+
+def count(name: str, value: int = 1) -> None:
+    recorded["counters"][name] += value
+
+
+def count_file(name: str, file: Path) -> None:
+    # Media is read and written by ffmpeg processes, so bytes are counted as the sizes of the files they handle
+    try:
+        count(name, Path(file).stat().st_size)
+    except FileNotFoundError:
+        pass
+
+
+def current_rss_bytes(pid: Optional[int] = None) -> int:
+    # Resident memory of a process now, unlike the peak it drops again when memory is given back
+    try:
+        with open(f"/proc/{pid or 'self'}/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if pid is None else 0
+
+
+def descendant_pids() -> List[int]:
+    # Render pool workers and ffmpeg processes started by this process, at any depth
+    parents = {}
+    for entry in os.scandir("/proc"):
+        if entry.name.isdigit():
+            try:
+                with open(f"/proc/{entry.name}/stat", 'r') as f:
+                    # The command name is in parentheses and may contain spaces, the parent pid follows it
+                    parents[int(entry.name)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+    pids, found = [], [os.getpid()]
+    while found:
+        found = [pid for pid, parent in parents.items() if parent in found]
+        pids += found
+    return pids
+
+
+def sample_rss() -> None:
+    largest = current_rss_bytes()
+    try:
+        largest = max([largest] + [current_rss_bytes(pid) for pid in descendant_pids()])
+    except OSError:
+        pass
+    recorded["peak_rss_bytes"] = max(recorded["peak_rss_bytes"], largest)
+
+
+def peak_rss_bytes() -> int:
+    # Largest resident memory of a single process of the job since the last reset, as sampled. Not
+    # ru_maxrss, which is the peak over the process's whole life and so, in warm and batch workers
+    # rendering job after job, the peak of the heaviest earlier job.
+    return max(recorded["peak_rss_bytes"], current_rss_bytes())
+
+
+class RssSampler:
+    # Samples this process and its descendants in the background while a job runs
+
+    def __init__(self, interval: float = RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            sample_rss()
+            self.stopped.wait(self.interval)
+
+    def start(self) -> "RssSampler":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+        sample_rss()
+
+
+def snapshot() -> Dict:
+    return {
+        "stages": {name: dict(totals) for name, totals in recorded["stages"].items()},
+        "counters": dict(recorded["counters"]),
+        "peak_rss_bytes": peak_rss_bytes()
+    }
+
+
+def reset() -> None:
+    recorded["stages"].clear()
+    recorded["counters"].clear()
+    recorded["peak_rss_bytes"] = 0
+
+
+def merge(measurements: Dict) -> None:
+    for name, totals in measurements["stages"].items():
+        recorded["stages"][name]["seconds"] += totals["seconds"]
+        recorded["stages"][name]["calls"] += totals["calls"]
+    for name, value in measurements["counters"].items():
+        recorded["counters"][name] += value
+    recorded["counters"]["worker_peak_rss_bytes"] = max(
+        recorded["counters"]["worker_peak_rss_bytes"], measurements["peak_rss_bytes"]
+    )
+
+
+def job_report(elapsed: float) -> Dict:
+    measurements = snapshot()
+    counters = measurements["counters"]
+    encoding_seconds = measurements["stages"].get("encoding", {}).get("seconds", 0.0)
+    return {
+        "elapsed_seconds": elapsed,
+        "stages": measurements["stages"],
+        "frames_encoded": counters.get("frames_encoded", 0),
+        "encoding_fps": counters.get("frames_encoded", 0) / encoding_seconds if encoding_seconds else None,
+        "bytes_read": counters.get("bytes_read", 0),
+        "bytes_written": counters.get("bytes_written", 0),
+        "peak_rss_bytes": max(measurements["peak_rss_bytes"], counters.get("worker_peak_rss_bytes", 0)),
+        "counters": counters
+    }
+
+
+def write_report(report: Dict, report_file: Path) -> None:
+    report_file = Path(report_file)
+    temporary_file = report_file.with_name(f".{report_file.name}.{uuid.uuid4().hex}")
+    with open(temporary_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(temporary_file, report_file)
+
+
+def read_report(report_file: Path) -> Optional[Dict]:
+    try:
+        with open(report_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class JobMetrics:
+    # Totals over every finished job, rendered in the Prometheus text exposition format
+
+    def __init__(self):
+        self.jobs = defaultdict(int)
+        self.job_seconds = 0.0
+        self.stages = defaultdict(lambda: {"seconds": 0.0, "calls": 0})
+        self.totals = defaultdict(int)
+        self.last_peak_rss_bytes = 0
+
+    def add(self, state: str, report: Optional[Dict]) -> None:
+        self.jobs[state] += 1
+        if report is None:
+            return
+        self.job_seconds += report["elapsed_seconds"]
+        for name, totals in report["stages"].items():
+            self.stages[name]["seconds"] += totals["seconds"]
+            self.stages[name]["calls"] += totals["calls"]
+        for name in ("frames_encoded", "bytes_read", "bytes_written"):
+            self.totals[name] += report[name]
+        self.last_peak_rss_bytes = report["peak_rss_bytes"]
+
+    def prometheus_text(self, job_states: Dict[str, int]) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: Iterable):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric("render_jobs_finished_total", "counter", "Render jobs finished, by final state",
+               [({"state": state}, self.jobs[state]) for state in ("done", "failed")])
+        metric("render_jobs", "gauge", "Render jobs currently in each state",
+               [({"state": state}, jobs) for state, jobs in job_states.items()])
+        metric("render_job_seconds_total", "counter", "Wall time of finished render jobs", [({}, self.job_seconds)])
+        metric("render_stage_seconds_total", "counter", "Time spent in each render stage, summed over processes",
+               [({"stage": name}, totals["seconds"]) for name, totals in sorted(self.stages.items())])
+        metric("render_stage_calls_total", "counter", "Times each render stage ran",
+               [({"stage": name}, totals["calls"]) for name, totals in sorted(self.stages.items())])
+        metric("render_frames_encoded_total", "counter", "Video frames encoded", [({}, self.totals["frames_encoded"])])
+        metric("render_bytes_read_total", "counter", "Bytes of media files opened for reading", [({}, self.totals["bytes_read"])])
+        metric("render_bytes_written_total", "counter", "Bytes of media files written", [({}, self.totals["bytes_written"])])
+        metric("render_last_job_peak_rss_bytes", "gauge", "Peak resident memory of the last finished job's processes",
+               [({}, self.last_peak_rss_bytes)])
+        return "\n".join(lines) + "\n"
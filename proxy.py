@@ -0,0 +1,57 @@
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from ffmpeg_backend import probe_video, run_ffmpeg
+from segment_cache import file_digest
+
+# Bump when proxies made from the same source and settings would come out differently
+PROXY_VERSION = 1
+
+# Proxies are meant to be decoded fast and seeked often, so they get a short keyframe interval
+PROXY_PRESET = "ultrafast"
+PROXY_KEYFRAME_SECONDS = 1
+
+
+def proxy_fps(file: Path, max_fps: float) -> float:
+    return min(probe_video(Path(file))["video_fps"], max_fps)
+
+
+def proxy_size(file: Path, height: int) -> (int, int):
+    # The frame size make_proxy's scale filter gives, without making the proxy
+    width, source_height = probe_video(Path(file))["video_size"]
+    proxy_height = min(height, source_height)
+    return max(2, round(width * proxy_height / source_height / 2) * 2), proxy_height
+
+
+def make_proxy(file: Path, cache_dir: Path, height: int, max_fps: float, audio: bool = True) -> Path:
+    # A low-resolution copy of a video, at most height pixels tall and max_fps frames per second,
+    # with the same duration so every timestamp of the render plan still points at the same picture.
+    # Proxies are stored by source content and settings, so later previews reuse them.
+    file = Path(file)
+    cache_dir = Path(cache_dir)
+    fps = proxy_fps(file, max_fps)
+    audio_suffix = "" if audio else "_an"
+    proxy_file = cache_dir / f"{file_digest(file)}_{height}p{fps:g}{audio_suffix}_v{PROXY_VERSION}.mp4"
+    if proxy_file.exists():
+        return proxy_file
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    temporary_file = proxy_file.with_name(f".{uuid.uuid4().hex}_{proxy_file.name}")
+    run_ffmpeg([
+        "-i", file, "-map", "0:v:0", *(["-map", "0:a:0?", "-c:a", "copy"] if audio else ["-an"]),
+        "-vf", f"scale=-2:'min({height},ih)',fps={fps:g}",
+        "-c:v", "libx264", "-preset", PROXY_PRESET, "-g", max(1, round(fps * PROXY_KEYFRAME_SECONDS)), "-pix_fmt", "yuv420p",
+        temporary_file
+    ])
+    os.replace(temporary_file, proxy_file)
+    logging.info(f"Created proxy {proxy_file} of {file}")
+    return proxy_file
+
+
+def proxy_scale(file: Path, proxy_file: Optional[Path]) -> float:
+    # How much smaller the proxy's frames are, for sizes given in pixels of the source
+    if proxy_file is None:
+        return 1.0
+    return probe_video(Path(proxy_file))["video_size"][1] / probe_video(Path(file))["video_size"][1]
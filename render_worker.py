@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+import metrics
+
+# A warm worker renders at most this many jobs, or stops once its resident memory passes the limit,
+# and a fresh one takes its place; both bound what leaks or fragments over a long run. The limit is
+# only checked between jobs, and a moviepy job holds up to its loop frame cache (test.py's
+# DEFAULT_LOOP_CACHE_BYTES, 0.5 GB, split between the job's render processes) on top of its frames.
+RENDER_WORKER_MAX_JOBS = 25
+RENDER_WORKER_MAX_RSS_BYTES = 4 * 1024 ** 3
+
+
+class RenderWorker:
+    # A long-lived render process that loaded moviepy, the subtitle font and aeneas once and renders
+    # the jobs handed to it one after another, so a job starts without an interpreter's cold start.
+    # Jobs and results travel as JSON lines over the process's stdin and stdout.
+
+    def __init__(self, max_jobs: int = RENDER_WORKER_MAX_JOBS, max_rss_bytes: int = RENDER_WORKER_MAX_RSS_BYTES):
+        self.max_jobs = max_jobs
+        self.max_rss_bytes = max_rss_bytes
+        self.process = None
+
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        # Returns once the worker has loaded everything, a no-op while one is running
+        if self.running():
+            return
+        started = time.perf_counter()
+        self.process = subprocess.Popen(
+            [sys.executable, Path(__file__).resolve().as_posix(), "--max_jobs", str(self.max_jobs), "--max_rss", str(self.max_rss_bytes)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        if self.receive() is None:
+            raise RuntimeError(f"Render worker exited with code {self.process.wait()} while starting")
+        logging.info(f"Render worker {self.process.pid} ready in {time.perf_counter() - started:.1f}s")
+
+    def receive(self) -> Optional[Dict]:
+        line = self.process.stdout.readline()
+        return json.loads(line) if line else None
+
+    def run(self, arguments: Dict, log_file: Path) -> Dict:
+        # test.main's keyword arguments; returns the job's state and error
+        self.start()
+        try:
+            self.process.stdin.write((json.dumps({"arguments": arguments, "log_file": Path(log_file).as_posix()}) + "\n").encode('utf-8'))
+            self.process.stdin.flush()
+            result = self.receive()
+        except BrokenPipeError:
+            result = None
+        if result is None:
+            code = self.process.wait()
+            self.process = None
+            return {"state": "failed", "error": f"The render process exited with code {code}", "recycle": True}
+        if result["recycle"]:
+            logging.info(f"Recycling render worker {self.process.pid}")
+            self.process.wait()
+            self.process = None
+        return result
+
+    def stop(self) -> None:
+        if self.running():
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+
+def preload() -> None:
+    # test imports moviepy.editor, which resolves the ffmpeg and ImageMagick binaries
+    import test
+    from subtitle_renderer import load_font
+
+    load_font(test.SUBTITLE_FONT, 33)
+    try:
+        import aeneas.executetask
+        import aeneas.task
+    except ImportError:
+        logging.warning("aeneas is not installed, jobs without a cached alignment will fail")
+
+
+@contextmanager
+def redirect_output(log_file: Path):
+    # Everything written to stdout and stderr during a job, by Python and by ffmpeg, goes to its log
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(log_file, 'wb') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+def render(arguments: Dict, log_file: Path) -> Dict:
+    import test
+
+    # main reports what this process measured since the last reset
+    metrics.reset()
+    with redirect_output(log_file):
+        try:
+            test.main(**arguments)
+            return {"state": "done", "error": None}
+        except Exception as e:
+            traceback.print_exc()
+            return {"state": "failed", "error": f"{type(e).__name__}: {e}"}
+
+
+def serve(max_jobs: int, max_rss_bytes: int) -> None:
+    # Replies go out on the original stdout, stray prints land on stderr instead of corrupting them
+    replies = os.fdopen(os.dup(1), 'w', buffering=1)
+    os.dup2(2, 1)
+    preload()
+    replies.write(json.dumps({"state": "ready"}) + "\n")
+    jobs = 0
+    for line in sys.stdin:
+        job = json.loads(line)
+        result = render(job["arguments"], Path(job["log_file"]))
+        jobs += 1
+        result["recycle"] = jobs >= max_jobs or metrics.current_rss_bytes() > max_rss_bytes
+        replies.write(json.dumps(result) + "\n")
+        if result["recycle"]:
+            logging.info(f"Render worker {os.getpid()} stops after {jobs} jobs at {metrics.current_rss_bytes() / 1024 ** 2:.0f} MB")
+            return
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Render jobs read as JSON lines from stdin in one warm process")
+    parser.add_argument("--max_jobs", "-mj", type=int, default=RENDER_WORKER_MAX_JOBS, help="Jobs rendered before the worker stops")
+    parser.add_argument("--max_rss", "-mr", type=int, default=RENDER_WORKER_MAX_RSS_BYTES,
+                        help="Resident memory in bytes past which the worker stops after its current job")
+
+    args = parser.parse_args()
+    serve(args.max_jobs, args.max_rss)
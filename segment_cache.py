@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict
+
+# Bump when a change to the renderer alters the pixels of a segment rendered from the same inputs
+SEGMENT_CACHE_VERSION = 3
+
+
+@lru_cache(maxsize=None)
+def _file_digest(file: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(file: Path) -> str:
+    stat = file.stat()
+    return _file_digest(file.resolve().as_posix(), stat.st_size, stat.st_mtime_ns)
+
+
+def segment_cache_key(inputs: Dict) -> str:
+    payload = json.dumps({"version": SEGMENT_CACHE_VERSION, "inputs": inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def place_file(source: Path, destination: Path) -> None:
+    # Hard link when both paths share a file system, copy otherwise; replaced atomically either way
+    temporary = destination.with_name(f".{destination.name}.{uuid.uuid4().hex}")
+    try:
+        os.link(source, temporary)
+    except OSError:
+        shutil.copyfile(source, temporary)
+    os.replace(temporary, destination)
+
+
+class SegmentCache:
+    # Rendered segments on disk, addressed by a hash of everything that went into them.
+    # Several jobs and pool workers may share the directory; eviction is least recently used by mtime.
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.evict()
+
+    def path_for(self, key: str) -> Path:
+        return self.directory / f"{key}.mp4"
+
+    def fetch(self, key: str, destination: Path) -> bool:
+        cached_file = self.path_for(key)
+        try:
+            place_file(cached_file, destination)
+            os.utime(cached_file)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key: str, source: Path) -> None:
+        place_file(source, self.path_for(key))
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for cached_file in self.directory.glob("*.mp4"):
+            try:
+                stat = cached_file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, cached_file))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, cached_file in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                cached_file.unlink()
+                logging.info(f"Evicted cached segment {cached_file.name}")
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
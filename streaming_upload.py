@@ -0,0 +1,220 @@
+import logging
+import os
+import shutil
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional
+
+UPLOAD_FIELDS = ("video_file", "clips_folder", "mp3_file", "text_file")
+
+# Bytes copied from the request body to disk per read
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+LOCAL_FILE_HEADER = b"PK\x03\x04"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+LOCAL_HEADER_FORMAT = "<4sHHHHHIIIHH"
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+
+
+class UploadError(Exception):
+    pass
+
+
+class StreamingZipExtractor:
+    # Extracts the entries of a zip file that is still being written, reading the local file
+    # headers in order instead of the central directory at its end. feed() extracts whatever
+    # complete data is on disk so far. Entries this cannot follow (encrypted, zip64, stored
+    # entries of unknown size) stop the streaming, and finish() unpacks the whole archive instead.
+
+    def __init__(self, zip_file: Path, output_dir: Path):
+        self.zip_file = Path(zip_file)
+        self.output_dir = Path(output_dir).resolve()
+        self.position = 0
+        self.entry = None
+        self.streaming = True
+        self.done = False
+        self.extracted = 0
+
+    def feed(self) -> None:
+        if not self.streaming or self.done:
+            return
+        with open(self.zip_file, 'rb') as f:
+            available = os.fstat(f.fileno()).st_size
+            while self.streaming and not self.done:
+                f.seek(self.position)
+                progressed = self.read_entry(f, available) if self.entry else self.read_header(f, available)
+                if not progressed:
+                    break
+
+    def finish(self) -> None:
+        self.feed()
+        if self.entry is not None or not self.done:
+            if self.streaming:
+                logging.warning(f"{self.zip_file} ended inside an entry, unpacking it again as a whole")
+            self.close_entry()
+            shutil.unpack_archive(self.zip_file.as_posix(), self.output_dir.as_posix(), "zip")
+        logging.info(f"Extracted {self.zip_file}")
+
+    def stop_streaming(self, reason: str) -> None:
+        logging.info(f"Streaming extraction of {self.zip_file} stopped: {reason}")
+        self.close_entry()
+        self.streaming = False
+
+    def read_header(self, f: BinaryIO, available: int) -> bool:
+        if available - self.position < 4:
+            return False
+        signature = f.read(4)
+        if signature != LOCAL_FILE_HEADER:
+            # Central directory or end record, every entry has been seen
+            self.done = True
+            return False
+        if available - self.position < LOCAL_HEADER_SIZE:
+            return False
+        f.seek(self.position)
+        (_, _, flags, method, _, _, _, compressed_size, size, name_length, extra_length) = struct.unpack(
+            LOCAL_HEADER_FORMAT, f.read(LOCAL_HEADER_SIZE)
+        )
+        header_size = LOCAL_HEADER_SIZE + name_length + extra_length
+        if available - self.position < header_size:
+            return False
+        name = f.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        has_descriptor = bool(flags & 0x8)
+        if flags & 0x1:
+            self.stop_streaming(f"{name} is encrypted")
+            return False
+        if method not in (0, 8) or compressed_size == 0xFFFFFFFF:
+            self.stop_streaming(f"{name} uses compression method {method} or zip64")
+            return False
+        if method == 0 and has_descriptor:
+            self.stop_streaming(f"{name} is stored without a size")
+            return False
+
+        target = (self.output_dir / name).resolve()
+        if target != self.output_dir and self.output_dir not in target.parents:
+            raise UploadError(f"Zip entry {name} points outside of the extraction directory")
+        output = None
+        if name.endswith("/"):
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            output = open(target, 'wb')
+        self.entry = {
+            "name": name,
+            "output": output,
+            "remaining": None if has_descriptor else compressed_size,
+            "has_descriptor": has_descriptor,
+            "decompressor": zlib.decompressobj(-zlib.MAX_WBITS) if method == 8 else None
+        }
+        self.position += header_size
+        return True
+
+    def read_entry(self, f: BinaryIO, available: int) -> bool:
+        entry = self.entry
+        if entry["remaining"] == 0 or (entry["decompressor"] is not None and entry["decompressor"].eof):
+            return self.read_descriptor(f, available)
+        readable = available - self.position
+        if entry["remaining"] is not None:
+            readable = min(readable, entry["remaining"])
+        if readable <= 0:
+            return False
+        data = f.read(min(readable, UPLOAD_BUFFER_SIZE))
+        consumed = len(data)
+        if entry["decompressor"] is not None:
+            data = entry["decompressor"].decompress(data)
+            # Without a size the deflate stream itself tells where the entry ends
+            consumed -= len(entry["decompressor"].unused_data)
+        if entry["output"] is not None:
+            entry["output"].write(data)
+        self.position += consumed
+        if entry["remaining"] is not None:
+            entry["remaining"] -= consumed
+        return True
+
+    def read_descriptor(self, f: BinaryIO, available: int) -> bool:
+        descriptor_size = 0
+        if self.entry["has_descriptor"]:
+            if available - self.position < 16:
+                return False
+            descriptor_size = 16 if f.read(4) == DATA_DESCRIPTOR else 12
+        self.position += descriptor_size
+        self.close_entry()
+        self.extracted += 1
+        return True
+
+    def close_entry(self) -> None:
+        if self.entry is not None and self.entry["output"] is not None:
+            self.entry["output"].close()
+        self.entry = None
+
+
+class UploadSession:
+    # The four files of one job, each uploaded in chunks at increasing offsets straight into
+    # the job directory. A chunk at the wrong offset is refused with the size already received,
+    # so an interrupted upload resumes where it stopped.
+
+    def __init__(self, job_dir: Path):
+        self.job_dir = Path(job_dir)
+        self.files = {}
+        self.lock = threading.Lock()
+        self.clips_dir = self.job_dir / "clips"
+        self.extractor = None
+        self.alignment = None
+
+    def field_dir(self, field: str) -> Path:
+        return self.job_dir / {"video_file": "video", "clips_folder": "clips", "mp3_file": "mp3", "text_file": "text"}[field]
+
+    def status(self) -> Dict:
+        return {
+            field: {"received": upload["received"], "total": upload["total"], "complete": upload["complete"]}
+            for field, upload in self.files.items()
+        }
+
+    def path(self, field: str) -> Optional[Path]:
+        upload = self.files.get(field)
+        return upload["path"] if upload else None
+
+    def complete(self, *fields: str) -> bool:
+        return all(field in self.files and self.files[field]["complete"] for field in fields or UPLOAD_FIELDS)
+
+    def write_chunk(self, field: str, filename: str, offset: Optional[int], total: Optional[int], stream: BinaryIO) -> bool:
+        # Appends the chunk if it starts where the file ends, returns whether it was written. An empty
+        # file is uploaded as one empty chunk with a total of 0.
+        if field not in UPLOAD_FIELDS:
+            raise UploadError(f"Unknown upload field {field}")
+        if not isinstance(offset, int) or not isinstance(total, int) or offset < 0 or total < 0:
+            raise UploadError("Chunks need a whole, non-negative offset and total size")
+        if field == "clips_folder" and total == 0:
+            raise UploadError("The clips folder is an empty file, not a zip archive")
+        with self.lock:
+            upload = self.files.get(field)
+            if upload is None:
+                directory = self.field_dir(field)
+                directory.mkdir(parents=True, exist_ok=True)
+                upload = {
+                    "path": directory / filename, "received": 0, "total": total, "complete": False, "lock": threading.Lock()
+                }
+                self.files[field] = upload
+                if field == "clips_folder":
+                    self.extractor = StreamingZipExtractor(upload["path"], self.clips_dir)
+        # One writer per file, a retried chunk racing the original one is refused like a wrong offset
+        if not upload["lock"].acquire(blocking=False):
+            return False
+        try:
+            if upload["complete"] or offset != upload["received"] or total != upload["total"]:
+                return False
+            with open(upload["path"], 'ab') as f:
+                for chunk in iter(lambda: stream.read(UPLOAD_BUFFER_SIZE), b''):
+                    f.write(chunk[:upload["total"] - upload["received"]])
+                    upload["received"] = min(upload["total"], upload["received"] + len(chunk))
+            if field == "clips_folder":
+                self.extractor.feed()
+            if upload["received"] == upload["total"]:
+                if field == "clips_folder":
+                    self.extractor.finish()
+                upload["complete"] = True
+                logging.info(f"Received {upload['path']} ({upload['total']} bytes)")
+            return True
+        finally:
+            upload["lock"].release()
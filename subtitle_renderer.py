@@ -0,0 +1,154 @@
+import subprocess
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Rasterized captions kept in memory; subtitles repeat across variations so most lookups hit.
+# An overlay is close to 1 MB at 1040 px wide, so clear_caption_caches empties them after every job.
+CAPTION_CACHE_SIZE = 512
+# Fonts stay loaded across jobs, a job uses one font at a size or two
+FONT_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def find_font_file(font: str) -> str:
+    try:
+        # Pillow searches the system font directories for bare file names
+        ImageFont.truetype(f"{font}.ttf")
+        return f"{font}.ttf"
+    except OSError:
+        pass
+    # Fall back to fontconfig, which is how ImageMagick resolved font names
+    try:
+        result = subprocess.run(["fc-match", "--format=%{file}", font], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Font not found: {font} (fontconfig is not installed)")
+    font_file = result.stdout.decode('utf-8').strip()
+    if result.returncode != 0 or not font_file:
+        raise FileNotFoundError(f"Font not found: {font}")
+    return font_file
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(find_font_file(font), font_size)
+
+
+def wrap_text(text: str, font: ImageFont.FreeTypeFont, width: int) -> List[str]:
+    lines = []
+    for paragraph in text.splitlines() or [""]:
+        line = ""
+        for word in paragraph.split():
+            candidate = f"{line} {word}" if line else word
+            if line and font.getlength(candidate) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+@lru_cache(maxsize=CAPTION_CACHE_SIZE)
+def render_caption(
+    text: str,
+    font: str,
+    font_size: int,
+    color: str,
+    width: int,
+    stroke_color: str = "white",
+    stroke_width: int = 1
+) -> np.ndarray:
+    # Word-wrapped, centered caption as an RGBA array of the given width, like TextClip(method='caption')
+    freetype_font = load_font(font, font_size)
+    lines = wrap_text(text, freetype_font, width - 2 * stroke_width)
+    ascent, descent = freetype_font.getmetrics()
+    line_height = ascent + descent
+    height = line_height * len(lines) + 2 * stroke_width
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for line_number, line in enumerate(lines):
+        draw.text(
+            (width / 2, stroke_width + line_number * line_height),
+            line,
+            font=freetype_font,
+            fill=color,
+            anchor="ma",
+            stroke_width=stroke_width,
+            stroke_fill=stroke_color
+        )
+    caption = np.array(image)
+    # Cached arrays are shared between clips, make sure nobody draws into them
+    caption.setflags(write=False)
+    return caption
+
+
+@lru_cache(maxsize=CAPTION_CACHE_SIZE)
+def render_subtitle_overlay(
+    text: str,
+    font: str,
+    font_size: int,
+    color: str,
+    width: int,
+    margin: int,
+    box_color: Tuple[int, int, int] = (0, 0, 0),
+    box_opacity: float = 0.7,
+    stroke_color: str = "white",
+    stroke_width: int = 1
+) -> Tuple[np.ndarray, np.ndarray]:
+    # The caption over its translucent box, flattened into one premultiplied layer:
+    # 8.8 fixed-point color (h, w, 3) and the weight left for the frame below (h, w, 1),
+    # so blending a frame is frame * weight + color, shifted back by 8 bits.
+    caption = render_caption(text, font, font_size, color, width, stroke_color, stroke_width)
+    text_height = caption.shape[0]
+    box_height = text_height + margin
+    caption_top = margin // 2
+    text_alpha = np.zeros((box_height, width, 1), dtype=np.float64)
+    text_alpha[caption_top:caption_top + text_height] = caption[:, :, 3:] / 255.0
+    text_color = np.zeros((box_height, width, 3), dtype=np.float64)
+    text_color[caption_top:caption_top + text_height] = caption[:, :, :3]
+    box_color = np.array(box_color, dtype=np.float64)
+    color_layer = text_alpha * text_color + (1.0 - text_alpha) * box_opacity * box_color
+    weight_layer = (1.0 - text_alpha) * (1.0 - box_opacity)
+    premultiplied = np.rint(color_layer * 256).astype(np.uint16)
+    weight = np.rint(weight_layer * 256).astype(np.uint16)
+    premultiplied.setflags(write=False)
+    weight.setflags(write=False)
+    return premultiplied, weight
+
+
+def clear_caption_caches() -> None:
+    # Warm and batch workers render job after job, a job's captions are rarely the next one's
+    render_caption.cache_clear()
+    render_subtitle_overlay.cache_clear()
+
+
+def blend_subtitle_overlay(frame: np.ndarray, overlay: Tuple[np.ndarray, np.ndarray], x: int, y: int, scratch: np.ndarray = None) -> np.ndarray:
+    # Blends the overlay into frame in place, only the band under the box is read or written.
+    # scratch is an optional uint16 buffer shaped like the overlay, reused across frames.
+    premultiplied, weight = overlay
+    height, width = weight.shape[:2]
+    top, left = max(0, -y), max(0, -x)
+    bottom, right = min(height, frame.shape[0] - y), min(width, frame.shape[1] - x)
+    if top >= bottom or left >= right:
+        return frame
+    if scratch is None:
+        scratch = np.empty(premultiplied.shape, dtype=np.uint16)
+    band = frame[y + top:y + bottom, x + left:x + right]
+    blended = scratch[top:bottom, left:right]
+    np.multiply(band, weight[top:bottom, left:right], out=blended)
+    blended += premultiplied[top:bottom, left:right]
+    blended >>= 8
+    band[...] = blended
+    return frame
+
+
+def subtitle_overlay_to_rgba(overlay: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    # Straight-alpha RGBA image of a premultiplied overlay, for compositors outside this process
+    premultiplied, weight = overlay
+    alpha = 256 - weight.astype(np.float64)
+    color = np.divide(premultiplied, alpha, out=np.zeros(premultiplied.shape), where=alpha > 0)
+    rgba = np.concatenate([color, alpha * 255 / 256], axis=2)
+    return np.clip(np.rint(rgba), 0, 255).astype(np.uint8)
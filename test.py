@@ -1,59 +1,263 @@
 import logging
+import math
 from pathlib import Path
-from typing import List, Dict
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, List, Dict, Optional, Tuple
 import os
 import subprocess
+import time
+import multiprocessing
+import multiprocessing.util
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 import json
+import numpy as np
 import pysrt
 import shutil
-from moviepy.editor import (
-    AudioFileClip, ColorClip, CompositeVideoClip, concatenate_videoclips,
-    TextClip, VideoFileClip
-)
+import tempfile
+from moviepy.config import get_setting
+from moviepy.editor import AudioFileClip, concatenate_videoclips, VideoFileClip
 from logging import info, error, debug
 from moviepy.video.fx.crop import crop
 from moviepy.video.fx.loop import loop
+from moviepy.video.VideoClip import ColorClip, VideoClip
+from subtitle_renderer import blend_subtitle_overlay, clear_caption_caches, render_subtitle_overlay
+from ffmpeg_backend import (
+    encode_audio, mux_audio, probe_video, render_variation as render_variation_with_ffmpeg, run_ffmpeg
+)
+from segment_cache import SegmentCache, file_digest, segment_cache_key
+from alignment import align_text_to_audio, cached_alignment, proportional_fragments
+import cost_model
+import metrics
+from job_queue import JobStatus
+from keyframe_index import copy_frames, keyframe_index, read_packet_index, read_parameter_sets, stream_copy_compatible, stream_copy_range
+from proxy import make_proxy, proxy_fps, proxy_scale, proxy_size
+from frame_buffers import FrameCache, PooledVideoReader, shared_pool, write_target_frames, write_video_frames
 
 # Initialization
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG)
 
-# Set the path to the ImageMagick executable
-os.environ['IMAGEMAGICK_BINARY'] = '/usr/bin/convert'
+# Subtitle font, resolved by file name in the system font directories or through fontconfig
+SUBTITLE_FONT = "Montserrat-SemiBold"
+SUBTITLE_BOX_COLOR = (0, 0, 0)
+SUBTITLE_BOX_OPACITY = 0.7
+SUBTITLE_STROKE_COLOR = "white"
+SUBTITLE_STROKE_WIDTH = 1
+
+# Encoder settings shared by every render path so segments can be joined by stream copy
+VIDEO_CODEC = "libx264"
+VIDEO_PRESET = "medium"
+AUDIO_CODEC = "aac"
+# Stream codec and pixel format VIDEO_CODEC writes, input footage already in them can be stream-copied
+VIDEO_STREAM_CODEC = "h264"
+VIDEO_PIX_FMT = "yuv420p"
+
+# Preview renders: proxy height in pixels, frame rate cap and encoder preset
+PREVIEW_HEIGHT = 480
+PREVIEW_FPS = 15
+PREVIEW_PRESET = "ultrafast"
+
+# Replacement clip readers kept open at once by each render process
+DEFAULT_MAX_OPEN_READERS = 8
+
+# Rendered segments kept across jobs when a segment cache directory is given
+DEFAULT_SEGMENT_CACHE_BYTES = 20 * 1024 ** 3
 
+# Replacement clips are cropped to this aspect ratio, then fitted to the input video's frame
+REPLACEMENT_ASPECT_RATIO = 4 / 5
 
-def load_video_from_file(file: Path) -> VideoFileClip:
+# Decoded frames of looped segments a job keeps in memory for loops after the first pass, split
+# evenly between its render processes
+DEFAULT_LOOP_CACHE_BYTES = 512 * 1024 ** 2
+
+# Bump when the layout of a render plan changes
+RENDER_PLAN_VERSION = 1
+
+
+def load_video_from_file(file: Path, audio: bool = True) -> VideoFileClip:
     if not file.exists():
         raise FileNotFoundError(f"Video file not found: {file}")
-    return VideoFileClip(file.as_posix())
+    video = VideoFileClip(file.as_posix(), audio=audio)
+    # Frames are decoded into a reused pair of buffers rather than a new array each
+    video.reader.close()
+    video.reader = PooledVideoReader(file.as_posix())
+    return video
 
 
-def crop_to_aspect_ratio(video: VideoFileClip, desired_aspect_ratio: float) -> VideoFileClip:
-    video_aspect_ratio = video.w / video.h
+def aspect_ratio_crop_box(width: int, height: int, desired_aspect_ratio: float) -> (int, int, int, int):
+    video_aspect_ratio = width / height
     if video_aspect_ratio > desired_aspect_ratio:
-        new_width = int(desired_aspect_ratio * video.h)
-        new_height = video.h
-        x1 = (video.w - new_width) // 2
+        new_width = int(desired_aspect_ratio * height)
+        new_height = height
+        x1 = (width - new_width) // 2
         y1 = 0
     else:
-        new_width = video.w
-        new_height = int(video.w / desired_aspect_ratio)
+        new_width = width
+        new_height = int(width / desired_aspect_ratio)
         x1 = 0
-        y1 = (video.h - new_height) // 2
+        y1 = (height - new_height) // 2
     x2 = x1 + new_width
     y2 = y1 + new_height
+    return x1, y1, x2, y2
+
+
+class CroppedVideoReader(PooledVideoReader):
+    # Lets ffmpeg crop and scale while decoding, so frames reach Python already at their output size
+
+    def __init__(self, filename: str, crop_box: (int, int, int, int), size: (int, int)):
+        self.crop_box = crop_box
+        PooledVideoReader.__init__(self, filename, target_resolution=(size[1], size[0]))
+
+    def initialize(self, starttime=0):
+        self.close()
+        if starttime != 0:
+            offset = min(1, starttime)
+            input_args = ['-ss', "%.06f" % (starttime - offset), '-i', self.filename, '-ss', "%.06f" % offset]
+        else:
+            input_args = ['-i', self.filename]
+        x1, y1, x2, y2 = self.crop_box
+        command = [get_setting("FFMPEG_BINARY")] + input_args + [
+            '-loglevel', 'error',
+            '-f', 'image2pipe',
+            '-vf', 'crop=%d:%d:%d:%d,scale=%d:%d' % (x2 - x1, y2 - y1, x1, y1, *self.size),
+            '-sws_flags', self.resize_algo,
+            '-pix_fmt', self.pix_fmt,
+            '-vcodec', 'rawvideo', '-'
+        ]
+        self.proc = subprocess.Popen(
+            command, bufsize=self.bufsize, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL
+        )
+
+
+class CroppedVideoFileClip(VideoFileClip):
+    # VideoFileClip without audio whose frames are cropped and scaled by the decoder
+
+    def __init__(self, filename: str, crop_box: (int, int, int, int), size: (int, int)):
+        VideoClip.__init__(self)
+        self.reader = CroppedVideoReader(filename, crop_box, size)
+        self.duration = self.reader.duration
+        self.end = self.reader.duration
+        self.fps = self.reader.fps
+        self.size = self.reader.size
+        self.rotation = self.reader.rotation
+        self.filename = self.reader.filename
+        self.make_frame = lambda t: self.reader.get_frame(t)
+
+
+def load_cropped_video_from_file(file: Path, desired_aspect_ratio: float, size: (int, int)) -> CroppedVideoFileClip:
+    if not file.exists():
+        raise FileNotFoundError(f"Video file not found: {file}")
+    width, height = probe_video(file)["video_size"]
+    crop_box = aspect_ratio_crop_box(width, height, desired_aspect_ratio)
+    return CroppedVideoFileClip(file.as_posix(), crop_box, size)
+
+
+def crop_to_aspect_ratio(video: VideoFileClip, desired_aspect_ratio: float) -> VideoFileClip:
+    x1, y1, x2, y2 = aspect_ratio_crop_box(video.w, video.h, desired_aspect_ratio)
     return crop(video, x1=x1, y1=y1, x2=x2, y2=y2)
 
 
+def parse_target(text: str) -> Dict:
+    # "9:16" is the largest 9:16 box of the frame at its own resolution, "9:16@1080x1920" is also scaled to 1080x1920
+    aspect_ratio, _, size = text.partition("@")
+    try:
+        width_ratio, height_ratio = (float(part) for part in aspect_ratio.split(":"))
+        size = tuple(int(part) for part in size.split("x")) if size else None
+    except ValueError:
+        raise ValueError(f"Invalid target {text}, expected an aspect ratio like 9:16, optionally followed by a size like @1080x1920")
+    if width_ratio <= 0 or height_ratio <= 0 or (size is not None and (len(size) != 2 or min(size) <= 0)):
+        raise ValueError(f"Invalid target {text}, the aspect ratio and size must be positive")
+    return {"name": text.replace(":", "x").replace("@", "_"), "aspect_ratio": width_ratio / height_ratio, "size": size}
+
+
+def target_layout(target: Dict, frame_size: (int, int), scale: float = 1.0) -> Dict:
+    # Where a target is cut from composed frames of frame_size and the size it is encoded at, both even
+    # for yuv420p. Preview frames are smaller than the source by scale, explicit sizes shrink with them.
+    # Subtitles keep their size relative to the picture and are wrapped to the target's own width.
+    x1, y1, x2, y2 = aspect_ratio_crop_box(*frame_size, target["aspect_ratio"])
+    crop_width, crop_height = max(2, (x2 - x1) // 2 * 2), max(2, (y2 - y1) // 2 * 2)
+    size = (crop_width, crop_height)
+    if target["size"]:
+        size = tuple(max(2, round(length * scale / 2) * 2) for length in target["size"])
+    return {
+        "name": target["name"],
+        "crop": (x1, y1, x1 + crop_width, y1 + crop_height),
+        "size": size,
+        "subtitle_scale": scale * size[0] / crop_width
+    }
+
+
+def target_crop_size(target: Dict) -> (int, int):
+    x1, y1, x2, y2 = target["crop"]
+    return x2 - x1, y2 - y1
+
+
+def target_output_file(output_file: Path, target: Optional[Dict]) -> Path:
+    return output_file if target is None else output_file.with_name(f"{output_file.stem}_{target['name']}{output_file.suffix}")
+
+
+def variation_output_files(output_folder: Path, variation: int, targets: Optional[List[Dict]]) -> List[Path]:
+    # One file per target, or the variation's single file at the input video's size without targets
+    output_file = output_folder / f"output_variation_{variation}.mp4"
+    return [target_output_file(output_file, target) for target in targets] if targets else [output_file]
+
+
 def load_subtitles_from_file(srt_file: Path) -> pysrt.SubRipFile:
     if not srt_file.exists():
         raise FileNotFoundError(f"SRT File not found: {srt_file}")
     return pysrt.open(srt_file)
 
 
-def adjust_segment_duration(segment: VideoFileClip, duration: float) -> VideoFileClip:
+def loop_frames_fit(duration: float, fps: float, size: Tuple[int, int], depth: int = 3) -> bool:
+    # Whether every source frame of a looped segment fits in this process's loop frame cache
+    frame_cache = render_state.get("loop_frames")
+    width, height = size
+    return frame_cache is not None and (math.ceil(duration * fps) + 1) * width * height * depth <= frame_cache.max_bytes
+
+
+def cache_loop_frames(segment: VideoFileClip, source_start: float) -> VideoFileClip:
+    # Every pass of a loop would seek its reader back and restart the decoder, and a decoder started
+    # with -ss can land a frame late. When all frames of the segment fit in the loop frame cache, they
+    # are decoded once in one sequential read and every pass is served from memory; longer segments
+    # keep streaming. Frames are keyed by their frame index in the source.
+    frame_cache = render_state.get("loop_frames")
+    reader = getattr(segment, "reader", None)
+    if frame_cache is None or reader is None:
+        return segment
+    if not loop_frames_fit(segment.duration, reader.fps, segment.size, reader.depth):
+        debug(f"Looping {reader.filename} from {source_start:.2f}s without caching, its frames exceed the loop frame cache")
+        metrics.count("loops_streamed")
+        return segment
+    source = (reader.filename, getattr(reader, "crop_box", None), width, height)
+    metrics.count("loops_cached")
+
+    def frame_index(t):
+        return int(reader.fps * (source_start + t) + 0.00001)
+
+    def cached_frame(get_frame, t):
+        frame = frame_cache.get((source, frame_index(t)))
+        if frame is not None:
+            metrics.count("loop_frame_hits")
+            return frame
+        # Decodes every source frame of the segment in order, not only those this pass samples
+        index, wanted = frame_index(0), None
+        while index / reader.fps - source_start < segment.duration:
+            frame_time = max(0.0, index / reader.fps - source_start)
+            frame = frame_cache.put((source, index), get_frame(frame_time))
+            if index == frame_index(t):
+                wanted = frame
+            index += 1
+        return wanted if wanted is not None else get_frame(t)
+
+    return segment.fl(cached_frame)
+
+
+def adjust_segment_duration(segment: VideoFileClip, duration: float, source_start: float = 0.0) -> VideoFileClip:
+    # source_start is where segment starts in its source file
     current_duration = segment.duration
     if current_duration < duration:
-        return loop(segment, duration=duration)
+        return loop(cache_loop_frames(segment, source_start), duration=duration)
     elif current_duration > duration:
         return segment.subclip(0, duration)
     return segment
@@ -62,7 +266,8 @@ def adjust_segment_duration(segment: VideoFileClip, duration: float) -> VideoFil
 def adjust_segment_properties(segment: VideoFileClip, original: VideoFileClip) -> VideoFileClip:
     segment = segment.set_fps(original.fps)
     segment = segment.set_duration(segment.duration)
-    segment = segment.resize(newsize=(original.w, original.h))
+    if tuple(segment.size) != (original.w, original.h):
+        segment = segment.resize(newsize=(original.w, original.h))
     return segment
 
 
@@ -82,36 +287,90 @@ def get_segments_using_srt(video: VideoFileClip, subtitles: pysrt.SubRipFile) ->
     return video_segments, subtitle_segments
 
 
+def layout_subtitle(
+    subtitle: pysrt.SubRipItem, frame_size: (int, int), font_size: int = 33, color: str = "white", margin: int = 20
+) -> (Tuple[np.ndarray, np.ndarray], Tuple[int, int]):
+    # The subtitle's overlay, wrapped to the frame's width, and where it sits at the bottom of the frame
+    with metrics.stage("subtitle_render"):
+        overlay = render_subtitle_overlay(
+            subtitle.text,
+            SUBTITLE_FONT,
+            font_size,
+            color,
+            frame_size[0] - 2 * margin,
+            margin,
+            box_color=SUBTITLE_BOX_COLOR,
+            box_opacity=SUBTITLE_BOX_OPACITY,
+            stroke_color=SUBTITLE_STROKE_COLOR,
+            stroke_width=SUBTITLE_STROKE_WIDTH
+        )
+    box_height = overlay[1].shape[0]
+    return overlay, (margin, frame_size[1] - box_height - margin)
+
+
 def add_subtitles_to_clip(clip: VideoFileClip, subtitle: pysrt.SubRipItem, font_size: int = 33, color: str = "white", margin: int = 20) -> VideoFileClip:
     logging.info(f"Adding subtitle: {subtitle.text}")
-    subtitle_clip = TextClip(
-        subtitle.text,
-        fontsize=font_size,
-        color=color,
-        stroke_color="white",
-        stroke_width=1,
-        font="Montserrat-SemiBold",
-        method='caption',
-        align='center',
-        size=(clip.w - 2 * margin, None)
-    ).set_duration(subriptime_to_seconds(subtitle.end) - subriptime_to_seconds(subtitle.start))
-    text_width, text_height = subtitle_clip.size
-    box_width = clip.w - 2 * margin
-    box_height = text_height + margin
-    box_clip = ColorClip(size=(box_width, box_height), color=(0, 0, 0)).set_opacity(0.7).set_duration(subtitle_clip.duration)
-    box_position = ('center', clip.h - box_height - margin)
-    subtitle_position = ('center', clip.h - box_height - margin + (box_height - text_height) / 2)
-    box_clip = box_clip.set_position(box_position)
-    subtitle_clip = subtitle_clip.set_position(subtitle_position)
-    return CompositeVideoClip([clip, box_clip, subtitle_clip])
+    overlay, box_position = layout_subtitle(subtitle, clip.size, font_size, color, margin)
+    subtitle_duration = subriptime_to_seconds(subtitle.end) - subriptime_to_seconds(subtitle.start)
+    scratch = np.empty(overlay[0].shape, dtype=np.uint16)
+
+    def draw_subtitle(get_frame, t):
+        frame = get_frame(t)
+        # Like the box and text layers of a composite, the overlay ends with the subtitle
+        if t >= subtitle_duration:
+            return frame
+        # Readers hand out their cached frame, blend into a private copy from a reused buffer
+        with metrics.stage("compositing"):
+            return blend_subtitle_overlay(shared_pool(frame.shape).copy(frame), overlay, *box_position, scratch)
+
+    return clip.fl(draw_subtitle)
+
+
+def subtitle_events(
+    original_segments: List[VideoFileClip], final_segments: List[VideoFileClip], subtitles: pysrt.SubRipFile
+) -> List[Tuple[float, float, pysrt.SubRipItem]]:
+    # When the subtitles of replaced segments show in the joined segments, as add_subtitles_to_clip draws them
+    events = []
+    start = 0.0
+    for original_segment, final_segment, subtitle in zip(original_segments, final_segments, subtitles):
+        if final_segment is not original_segment:
+            subtitle_duration = subriptime_to_seconds(subtitle.end) - subriptime_to_seconds(subtitle.start)
+            events.append((start, start + min(subtitle_duration, final_segment.duration), subtitle))
+        start += final_segment.duration
+    return events
+
+
+def target_frame_composer(target: Dict, events: List[Tuple[float, float, pysrt.SubRipItem]]) -> Callable:
+    # Turns a composed frame into one of the target's, cropped and subtitled in the target's own layout.
+    # The encoder scales it to the target's size, subtitles are drawn in proportion to that size.
+    x1, y1, x2, y2 = target["crop"]
+    crop_size = (x2 - x1, y2 - y1)
+    scale = target["subtitle_scale"] * crop_size[0] / target["size"][0]
+    overlays = [
+        (start, end, *layout_subtitle(subtitle, crop_size, round(33 * scale), margin=round(20 * scale)))
+        for start, end, subtitle in events
+    ]
+
+    def compose(frame: np.ndarray, t: float) -> np.ndarray:
+        frame = frame[y1:y2, x1:x2]
+        for start, end, overlay, position in overlays:
+            if start <= t < end:
+                with metrics.stage("compositing"):
+                    frame = blend_subtitle_overlay(shared_pool(frame.shape).copy(frame), overlay, *position)
+        return frame
+
+    return compose
 
 
 def replace_video_segments(
     original_segments: List[VideoFileClip],
     replacement_videos: Dict[int, VideoFileClip],
     subtitles: pysrt.SubRipFile,
-    original_video: VideoFileClip
+    original_video: VideoFileClip,
+    subtitle_scale: float = 1.0,
+    add_subtitles: bool = True
 ) -> List[VideoFileClip]:
+    # Without add_subtitles the replaced segments are left bare, for targets that lay the subtitles out themselves
     combined_segments = original_segments.copy()
     for replace_index, replacement_video in replacement_videos.items():
         if 0 <= replace_index < len(combined_segments):
@@ -124,28 +383,49 @@ def replace_video_segments(
                 if end > replacement_video.duration:
                     end = replacement_video.duration
                 replacement_segment = replacement_video.subclip(start, end)
-                replacement_segment = adjust_segment_duration(replacement_segment, target_duration)
+                replacement_segment = adjust_segment_duration(replacement_segment, target_duration, start)
                 adjusted_segment = adjust_segment_properties(replacement_segment, original_video)
-                adjusted_segment_with_subtitles = add_subtitles_to_clip(adjusted_segment, subtitles[replace_index])
-                combined_segments[replace_index] = adjusted_segment_with_subtitles
+                if add_subtitles:
+                    adjusted_segment = add_subtitles_to_clip(
+                        adjusted_segment, subtitles[replace_index], font_size=round(33 * subtitle_scale), margin=round(20 * subtitle_scale)
+                    )
+                combined_segments[replace_index] = adjusted_segment
     return combined_segments
 
 
-def generate_srt_from_txt_and_audio(txt_file: Path, audio_file: Path, output_folder: Path) -> Path:
+def generate_srt_from_txt_and_audio(
+    txt_file: Path,
+    audio_file: Path,
+    output_folder: Path,
+    alignment_cache_dir: Optional[Path] = None,
+    chunked_alignment: bool = False
+) -> Path:
     output_file_path = txt_file.with_name(txt_file.stem + "_aligned.json")
-    command = f'python3.10 -m aeneas.tools.execute_task "{audio_file}" "{txt_file}" "task_language=eng|is_text_type=plain|os_task_file_format=json" "{output_file_path}"'
-    logging.info(f"Running command: {command}")
-    result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    logging.info(f"Aligning {txt_file} to {audio_file}")
+    fragments = align_text_to_audio(audio_file, txt_file, cache_dir=alignment_cache_dir, chunked=chunked_alignment)
+    sync_map = {"fragments": fragments}
+    with open(output_file_path, 'w') as f:
+        json.dump(sync_map, f)
+    return write_srt(sync_map['fragments'], txt_file.with_name(txt_file.stem + "_with_timestamps.srt"))
 
-    logging.info(f"Command output: {result.stdout.decode('utf-8')}")
-    logging.error(f"Command error: {result.stderr.decode('utf-8')}")
 
-    if not output_file_path.exists():
-        raise FileNotFoundError(f"The output file {output_file_path} was not created. Check the command output above for errors.")
+def estimate_srt_from_txt_and_audio(
+    txt_file: Path,
+    audio_file: Path,
+    srt_file: Path,
+    alignment_cache_dir: Optional[Path] = None,
+    chunked_alignment: bool = False
+) -> (Path, bool):
+    # For planning: the cached alignment when there is one, otherwise the lines spread evenly over
+    # the narration, never running the aligner. Also tells whether the timings are aligned ones.
+    fragments = cached_alignment(audio_file, txt_file, alignment_cache_dir, chunked_alignment)
+    if fragments is None:
+        logging.info(f"No cached alignment for {txt_file}, planning with estimated subtitle timings")
+        return write_srt(proportional_fragments(audio_file, txt_file), srt_file), False
+    return write_srt(fragments, srt_file), True
 
-    with open(output_file_path, 'r') as f:
-        sync_map = json.load(f)
 
+def write_srt(fragments: List[Dict], srt_file: Path) -> Path:
     def convert_time(seconds):
         milliseconds = int((seconds - int(seconds)) * 1000)
         minutes, seconds = divmod(int(seconds), 60)
@@ -153,13 +433,12 @@ def generate_srt_from_txt_and_audio(txt_file: Path, audio_file: Path, output_fol
         return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
 
     aligned_output = []
-    for index, fragment in enumerate(sync_map['fragments']):
+    for index, fragment in enumerate(fragments):
         start = convert_time(float(fragment['begin']))
         end = convert_time(float(fragment['end']))
         text = fragment['lines'][0].strip()
         aligned_output.append(f"{index + 1}\n{start} --> {end}\n{text}\n")
 
-    srt_file = txt_file.with_name(txt_file.stem + "_with_timestamps.srt")
     with open(srt_file, 'w') as file:
         for line in aligned_output:
             file.write(line + "\n")
@@ -167,35 +446,75 @@ def generate_srt_from_txt_and_audio(txt_file: Path, audio_file: Path, output_fol
     return srt_file
 
 
-def main(video_clips_path, my_video, mp3_file_of_same_video, txt_file_of_same_video, output_folder):
-    input_video_file = Path(my_video)
-    replacement_base_folder = Path(video_clips_path)
+def snap_segments_to_frames(segments: List[VideoFileClip], fps: float) -> List[VideoFileClip]:
+    # Segments encoded separately must start on the output frame grid, otherwise the
+    # per-segment rounding adds up and the joined video drifts away from the audio.
+    # Frame k belongs to the segment playing at k / fps, as in concatenate_videoclips.
+    snapped_segments = []
+    start = 0.0
+    start_frame = 0
+    for segment in segments:
+        end = start + segment.duration
+        end_frame = math.ceil(end * fps - 1e-6)
+        # Rounding can leave the offset a hair below zero, which subclip would count from the end
+        offset = max(0.0, start_frame / fps - start)
+        snapped_segments.append(segment.subclip(offset, offset + (end_frame - start_frame) / fps))
+        start, start_frame = end, end_frame
+    return snapped_segments
 
-    output_folder = Path(output_folder)
-    output_folder.mkdir(parents=True, exist_ok=True)
 
-    # Generate SRT file from TXT and MP3
-    srt_file = generate_srt_from_txt_and_audio(Path(txt_file_of_same_video), Path(mp3_file_of_same_video), output_folder)
-    logging.info("Generated SRT file from TXT and MP3")
+def write_segment(segment: VideoFileClip, output_file: Path, fps: float, threads: Optional[int] = None) -> Path:
+    frame_count = int(round(segment.duration * fps))
+    # Half a frame short so moviepy's float arange yields exactly frame_count frames
+    segment = segment.set_duration((frame_count - 0.5) / fps)
+    with metrics.stage("encoding"):
+        write_video_frames(segment, output_file, fps, VIDEO_CODEC, render_state["video_preset"], threads)
+    metrics.count("frames_encoded", frame_count)
+    metrics.count_file("bytes_written", output_file)
+    return output_file
 
-    video = load_video_from_file(input_video_file)
-    logging.info("Video loaded successfully")
-    cropped_video = crop_to_aspect_ratio(video, 4 / 5)
-    logging.info("Video cropped to desired aspect ratio")
-    subtitles = load_subtitles_from_file(srt_file)
-    logging.info("Loaded SRT Subtitles from the provided subtitle file")
-    video_segments, subtitle_segments = get_segments_using_srt(video, subtitles)
-    logging.info("Segmented Input video based on the SRT Subtitles generated for it")
-    output_video_segments = []
-    start = 0
-    for video_segment, new_subtitle_segment in zip(video_segments, subtitles):
-        end = subriptime_to_seconds(new_subtitle_segment.end)
-        required_duration = end - start
-        new_video_segment = adjust_segment_duration(video_segment, required_duration)
-        output_video_segments.append(new_video_segment.without_audio())
-        start = end
 
-    replacement_videos_per_combination = []
+def write_target_segments(
+    segment: VideoFileClip, output_files: List[Path], fps: float, threads: Optional[int], events: List[Tuple[float, float, pysrt.SubRipItem]]
+) -> List[Path]:
+    # write_segment for every target at once, from a single pass over the segment's frames
+    frame_count = int(round(segment.duration * fps))
+    segment = segment.set_duration((frame_count - 0.5) / fps)
+    with metrics.stage("encoding"):
+        write_target_frames(segment, target_outputs(output_files, events), fps, VIDEO_CODEC, render_state["video_preset"], threads)
+    metrics.count("frames_encoded", frame_count * len(output_files))
+    for output_file in output_files:
+        metrics.count_file("bytes_written", output_file)
+    return output_files
+
+
+def join_segments(segment_files: List[Path], audio_file: Optional[Path], output_file: Path) -> Path:
+    list_file = segment_files[0].parent / f"{output_file.stem}_segments.txt"
+    with open(list_file, 'w') as f:
+        for segment_file in segment_files:
+            escaped_path = segment_file.resolve().as_posix().replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+    input_args = ["-f", "concat", "-safe", "0", "-i", list_file] + (["-i", audio_file] if audio_file else [])
+    map_args = ["-map", "0:v:0"] + (["-map", "1:a:0"] if audio_file else [])
+    with metrics.stage("muxing"):
+        run_ffmpeg(input_args + map_args + ["-c", "copy", "-movflags", "+faststart", output_file])
+    metrics.count_file("bytes_written", output_file)
+    return output_file
+
+
+def prepare_job_audio(input_video_file: Path, duration: float, job_dir: Path) -> Optional[Path]:
+    # The narration is cut and AAC-encoded once, every variation copies this stream
+    if not probe_video(input_video_file)["audio_found"]:
+        logging.warning(f"{input_video_file} has no audio track, variations will be silent")
+        return None
+    with metrics.stage("audio_encoding"):
+        audio_file = encode_audio(input_video_file, duration, job_dir / "audio.m4a", AUDIO_CODEC)
+    logging.info(f"Encoded job audio: {audio_file}")
+    return audio_file
+
+
+def find_replacement_video_files(replacement_base_folder: Path) -> List[Dict[int, Path]]:
+    replacement_files_per_combination = []
 
     for folder in replacement_base_folder.iterdir():
         if not folder.is_dir():
@@ -207,29 +526,930 @@ def main(video_clips_path, my_video, mp3_file_of_same_video, txt_file_of_same_vi
             continue
 
         replace_index = int(folder_name) - 1
-        replacement_video_files = list(folder.glob("*.mp4"))
+        # Sorted, so the same clips always make up the same variation, in previews and full renders alike
+        replacement_video_files = sorted(folder.glob("*.mp4"))
         logging.info(f"Found {len(replacement_video_files)} replacement video files in {folder}")
 
         for replacement_video_file in replacement_video_files:
-            replacement_video = load_video_from_file(replacement_video_file)
-            cropped_replacement_video = crop_to_aspect_ratio(replacement_video, 4 / 5)
+            if len(replacement_files_per_combination) < len(replacement_video_files):
+                replacement_files_per_combination.append({})
+            replacement_files_per_combination[replacement_video_files.index(replacement_video_file)][replace_index] = replacement_video_file
+    return replacement_files_per_combination
+
+
+class ReplacementReaderPool:
+    # Replacement clips opened on first use and kept in a bounded pool, least recently used closed first.
+    # Every clip holds an ffmpeg reader process; clips pinned by a render in progress are never closed under it.
+
+    def __init__(self, size: (int, int), max_open: int = DEFAULT_MAX_OPEN_READERS):
+        self.size = size
+        self.max_open = max_open
+        self.readers = OrderedDict()
+        self.pins = Counter()
+
+    @contextmanager
+    def open(self, replacement_files: Dict[int, Path]):
+        acquired = []
+        try:
+            replacement_videos = {}
+            for replace_index, replacement_video_file in replacement_files.items():
+                replacement_videos[replace_index] = self.acquire(replacement_video_file)
+                acquired.append(replacement_video_file)
+            yield replacement_videos
+        finally:
+            for replacement_video_file in acquired:
+                self.release(replacement_video_file)
+
+    def acquire(self, replacement_video_file: Path) -> VideoFileClip:
+        if replacement_video_file in self.readers:
+            self.readers.move_to_end(replacement_video_file)
+        else:
+            # Decoded straight to the cropped output size, replacement audio is never used
+            with metrics.stage("replacement_load"):
+                self.readers[replacement_video_file] = load_cropped_video_from_file(replacement_video_file, REPLACEMENT_ASPECT_RATIO, self.size)
+            metrics.count_file("bytes_read", replacement_video_file)
             logging.info(f"Replacement video {replacement_video_file} cropped to desired aspect ratio")
-            if len(replacement_videos_per_combination) < len(replacement_video_files):
-                replacement_videos_per_combination.append({})
-            replacement_videos_per_combination[replacement_video_files.index(replacement_video_file)][replace_index] = cropped_replacement_video
+            debug(f"Opened replacement reader {replacement_video_file} ({len(self.readers)} open)")
+        self.pins[replacement_video_file] += 1
+        self.evict()
+        return self.readers[replacement_video_file]
+
+    def release(self, replacement_video_file: Path) -> None:
+        self.pins[replacement_video_file] -= 1
+        if self.pins[replacement_video_file] <= 0:
+            del self.pins[replacement_video_file]
+        self.evict()
+
+    def evict(self) -> None:
+        idle_files = [file for file in self.readers if file not in self.pins]
+        while len(self.readers) > self.max_open and idle_files:
+            self.close(idle_files.pop(0))
+
+    def close(self, replacement_video_file: Path) -> None:
+        self.readers.pop(replacement_video_file).close()
+        debug(f"Closed replacement reader {replacement_video_file} ({len(self.readers)} open)")
+
+    def close_all(self) -> None:
+        for replacement_video_file in list(self.readers):
+            self.close(replacement_video_file)
+
+
+def build_output_segments(video: VideoFileClip, subtitles: pysrt.SubRipFile) -> List[VideoFileClip]:
+    video_segments, subtitle_segments = get_segments_using_srt(video, subtitles)
+    logging.info("Segmented Input video based on the SRT Subtitles generated for it")
+    output_video_segments = []
+    start = 0
+    for video_segment, new_subtitle_segment in zip(video_segments, subtitles):
+        end = subriptime_to_seconds(new_subtitle_segment.end)
+        required_duration = end - start
+        new_video_segment = adjust_segment_duration(video_segment, required_duration, subriptime_to_seconds(new_subtitle_segment.start))
+        output_video_segments.append(new_video_segment.without_audio())
+        start = end
+    return output_video_segments
+
+
+# Per-process render state, filled by init_render_worker in the main process and in every pool worker
+render_state = {}
+
+
+def init_render_worker(
+    input_video_file: Path,
+    srt_file: Path,
+    render_mode: str = "full",
+    progress_logger: Optional[str] = "bar",
+    segment_cache_dir: Optional[Path] = None,
+    segment_cache_bytes: int = DEFAULT_SEGMENT_CACHE_BYTES,
+    max_open_readers: int = DEFAULT_MAX_OPEN_READERS,
+    smart_cut_index: Optional[Dict] = None,
+    video_preset: str = VIDEO_PRESET,
+    subtitle_scale: float = 1.0,
+    targets: Optional[List[Dict]] = None,
+    loop_cache_bytes: int = DEFAULT_LOOP_CACHE_BYTES
+) -> None:
+    # Whatever a job that failed before its finally left behind is closed, not overwritten
+    close_render_state()
+    # Filled first, the base segments already loop while they are built
+    render_state["loop_frames"] = FrameCache(loop_cache_bytes)
+    with metrics.stage("video_load"):
+        video = load_video_from_file(input_video_file)
+    # Kept right away, so close_render_state closes it should building the segments fail
+    render_state["video"] = video
+    metrics.count_file("bytes_read", input_video_file)
+    logging.info("Video loaded successfully")
+    subtitles = load_subtitles_from_file(srt_file)
+    logging.info("Loaded SRT Subtitles from the provided subtitle file")
+    with metrics.stage("segmentation"):
+        output_video_segments = build_output_segments(video, subtitles)
+    replacement_readers = ReplacementReaderPool(tuple(video.size), max_open_readers)
+    # Pool workers skip atexit handlers, multiprocessing finalizers still run when they exit
+    multiprocessing.util.Finalize(replacement_readers, replacement_readers.close_all, exitpriority=10)
+    render_state.update(
+        input_video_file=input_video_file,
+        video=video,
+        subtitles=subtitles,
+        output_video_segments=output_video_segments,
+        progress_logger=progress_logger,
+        replacement_readers=replacement_readers,
+        segment_cache=SegmentCache(segment_cache_dir, segment_cache_bytes) if segment_cache_dir else None,
+        smart_cut_index=smart_cut_index,
+        # Previews encode faster and draw subtitles in proportion to their smaller frames
+        video_preset=video_preset,
+        subtitle_scale=subtitle_scale,
+        # Every variation is cut to each of these instead of being written at the input video's size
+        targets=[target_layout(target, video.size, subtitle_scale) for target in targets] if targets else None
+    )
+    if render_mode == "segments":
+        with metrics.stage("segmentation"):
+            render_state["base_segments"] = snap_segments_to_frames(output_video_segments, video.fps)
+
+
+def close_render_state() -> None:
+    # Warm and batch workers render job after job in one process, so the job's base clip and its
+    # replacement readers are closed here and nothing of the job is left for the next one
+    if "replacement_readers" in render_state:
+        render_state["replacement_readers"].close_all()
+    if "video" in render_state:
+        render_state["video"].close()
+    render_state.clear()
+
+
+def encoder_threads(workers: int) -> Optional[int]:
+    # Concurrent libx264 encoders share the machine's cores instead of each spawning one thread per core
+    if workers <= 1:
+        return None
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+class InlineRenderTask:
+    # Future-like wrapper that runs a render task in this process the first time its result is needed
+
+    def __init__(self, function: Callable, *args):
+        self.function = function
+        self.args = args
+        self.done = False
+        self.value = None
+
+    def result(self):
+        if not self.done:
+            self.value = self.function(*self.args)
+            self.done = True
+        return self.value
+
+
+def create_render_pool(
+    workers: int,
+    input_video_file: Path,
+    srt_file: Path,
+    render_mode: str,
+    segment_cache_dir: Optional[Path] = None,
+    segment_cache_bytes: int = DEFAULT_SEGMENT_CACHE_BYTES,
+    max_open_readers: int = DEFAULT_MAX_OPEN_READERS,
+    smart_cut_index: Optional[Dict] = None,
+    video_preset: str = VIDEO_PRESET,
+    subtitle_scale: float = 1.0,
+    targets: Optional[List[Dict]] = None,
+    loop_cache_bytes: int = DEFAULT_LOOP_CACHE_BYTES
+) -> Optional[ProcessPoolExecutor]:
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_render_worker,
+        initargs=(
+            input_video_file, srt_file, render_mode, None, segment_cache_dir, segment_cache_bytes, max_open_readers, smart_cut_index,
+            video_preset, subtitle_scale, targets, loop_cache_bytes
+        )
+    )
+
+
+def run_measured_task(function: Callable, *args):
+    # Runs a task in a pool worker and hands what it measured back with its result
+    try:
+        return function(*args), metrics.snapshot()
+    finally:
+        metrics.reset()
+
+
+class MeasuredRenderTask:
+    # Future of a run_measured_task, adding the worker's measurements to this process's once
 
-    for i, replacement_videos in enumerate(replacement_videos_per_combination):
+    def __init__(self, future):
+        self.future = future
+        self.done = False
+        self.value = None
+
+    def result(self):
+        if not self.done:
+            self.value, measurements = self.future.result()
+            metrics.merge(measurements)
+            self.done = True
+        return self.value
+
+
+def submit_render_task(pool: Optional[Executor], function: Callable, *args):
+    if pool is None:
+        return InlineRenderTask(function, *args)
+    if isinstance(pool, ProcessPoolExecutor):
+        return MeasuredRenderTask(pool.submit(run_measured_task, function, *args))
+    return pool.submit(function, *args)
+
+
+def target_outputs(files: List[Path], events: List[Tuple[float, float, pysrt.SubRipItem]]) -> List[Dict]:
+    # write_target_frames outputs for this process's targets, in the same order as files
+    return [
+        {"file": file, "size": target_crop_size(target), "scale": target["size"], "compose": target_frame_composer(target, events)}
+        for file, target in zip(files, render_state["targets"])
+    ]
+
+
+def render_variation_task(
+    replacement_files: Dict[int, Path],
+    output_file: Path,
+    threads: Optional[int],
+    audio_file: Optional[Path],
+    job_dir: Path
+) -> float:
+    started = time.perf_counter()
+    video = render_state["video"]
+    targets = render_state["targets"]
+    output_files = [target_output_file(output_file, target) for target in targets] if targets else [output_file]
+    video_files = [job_dir / f"{file.stem}_video.mp4" for file in output_files]
+    with render_state["replacement_readers"].open(replacement_files) as replacement_videos:
         final_video_segments = replace_video_segments(
-            output_video_segments, replacement_videos, subtitles, video
+            render_state["output_video_segments"], replacement_videos, render_state["subtitles"], video, render_state["subtitle_scale"],
+            add_subtitles=not targets
         )
         concatenated_video = concatenate_videoclips(final_video_segments)
-        original_audio = video.audio.subclip(0, concatenated_video.duration)
-        final_video_with_audio = concatenated_video.set_audio(original_audio)
-        #tmp_path = Path('tmp')
+        with metrics.stage("encoding"):
+            if targets:
+                # One pass over the frames feeds an encoder per target
+                events = subtitle_events(render_state["output_video_segments"], final_video_segments, render_state["subtitles"])
+                frames_written = len(targets) * write_target_frames(
+                    concatenated_video, target_outputs(video_files, events), video.fps, VIDEO_CODEC, render_state["video_preset"],
+                    threads, render_state["progress_logger"]
+                )
+            else:
+                frames_written = write_video_frames(
+                    concatenated_video, video_files[0], video.fps, VIDEO_CODEC, render_state["video_preset"], threads,
+                    render_state["progress_logger"]
+                )
+        metrics.count("frames_encoded", frames_written)
+    for video_file, file in zip(video_files, output_files):
+        with metrics.stage("muxing"):
+            mux_audio(video_file, audio_file, file)
+        metrics.count_file("bytes_written", file)
+        video_file.unlink()
+    elapsed = time.perf_counter() - started
+    logging.info(f"Generated output video: {', '.join(str(file) for file in output_files)} in {elapsed:.1f}s")
+    return elapsed
+
+
+def segment_frame_range(index: int) -> Tuple[int, int]:
+    # First and last (exclusive) output frame of a base segment, also its frames in the input video when
+    # segment_maps_to_source
+    fps = render_state["video"].fps
+    frame_counts = [int(round(base_segment.duration * fps)) for base_segment in render_state["base_segments"]]
+    start_frame = sum(frame_counts[:index])
+    return start_frame, start_frame + frame_counts[index]
+
+
+def segment_maps_to_source(index: int) -> bool:
+    # Whether output frame k of a base segment is frame k of the input video. It is not when the
+    # segment's cue starts later than the previous one ends, or before it: build_output_segments then
+    # loops or trims the cue's footage to fill the slot, and copying the input's frames would differ.
+    subtitles = render_state["subtitles"]
+    slot_start = subriptime_to_seconds(subtitles[index - 1].end) if index > 0 else 0.0
+    return abs(subriptime_to_seconds(subtitles[index].start) - slot_start) < 1e-6
+
+
+def segment_cache_inputs(index: int, segment: Dict) -> Dict:
+    # Everything that determines the pixels of a rendered segment, with sources identified by content
+    start_frame, end_frame = segment_frame_range(index)
+    # A loop served from the frame cache and one streamed with a seek per pass can differ by a frame,
+    # and which one a segment gets depends on the loop cache budget and the worker count. Base footage
+    # loops to fill its cue's slot, a replacement to fill the snapped base segment it replaces.
+    source_duration = segment["end"] - segment["start"]
+    fps = render_state["video"].fps
+    slot_duration = segment["duration"] if segment["source"] == render_state["input_video_file"] else (end_frame - start_frame) / fps
+    loop_cached = (
+        loop_frames_fit(source_duration, probe_video(Path(segment["source"]))["video_fps"], tuple(render_state["video"].size))
+        if source_duration < slot_duration else None
+    )
+    smart_cut = (
+        render_state["smart_cut_index"] is not None and segment["source"] == render_state["input_video_file"]
+        and segment_maps_to_source(index)
+    )
+    return {
+        "segment": dict(segment, source=file_digest(Path(segment["source"]))),
+        "frames": [start_frame, end_frame - start_frame],
+        "fps": fps,
+        "codec": VIDEO_CODEC,
+        "preset": render_state["video_preset"],
+        "smart_cut": smart_cut,
+        "loop_cached": loop_cached
+    }
+
+
+@lru_cache(maxsize=None)
+def encoder_parameter_sets(size: Tuple[int, int], fps: float, preset: str) -> List[str]:
+    # The SPS and PPS the encoder writes for segments of this size, rate and preset, read from a
+    # two frame encode; they depend on the settings, not on the frames
+    with tempfile.TemporaryDirectory(prefix="encoder_") as reference_dir:
+        reference_file = Path(reference_dir) / "reference.mp4"
+        write_video_frames(ColorClip(size, color=(0, 0, 0)).set_duration(1.5 / fps), reference_file, fps, VIDEO_CODEC, preset)
+        return read_parameter_sets(reference_file)
+
+
+def write_original_segment(index: int, output_file: Path, threads: Optional[int]) -> Path:
+    # Whole GOPs of the input are stream-copied, only the frames between a segment boundary
+    # and the nearest keyframe inside the segment go through the encoder
+    segment = render_state["base_segments"][index]
+    smart_cut_index = render_state["smart_cut_index"]
+    fps = render_state["video"].fps
+    start_frame, end_frame = segment_frame_range(index)
+    copy_range = stream_copy_range(smart_cut_index, start_frame, end_frame) if smart_cut_index and segment_maps_to_source(index) else None
+    if copy_range is None:
+        return write_segment(segment, output_file, fps, threads)
+    copy_start, copy_end = copy_range
+    part_files = []
+    if copy_start > start_frame:
+        part_files.append(write_segment(
+            segment.subclip(0, (copy_start - start_frame) / fps), output_file.with_name(f"{output_file.stem}_head.mp4"), fps, threads
+        ))
+    with metrics.stage("stream_copy"):
+        part_files.append(copy_frames(
+            render_state["input_video_file"], smart_cut_index, copy_start, copy_end, output_file.with_name(f"{output_file.stem}_copy.mp4")
+        ))
+    metrics.count("frames_copied", copy_end - copy_start)
+    if copy_end < end_frame:
+        part_files.append(write_segment(
+            segment.subclip((copy_end - start_frame) / fps, (end_frame - start_frame) / fps),
+            output_file.with_name(f"{output_file.stem}_tail.mp4"), fps, threads
+        ))
+    join_segments(part_files, None, output_file)
+    for part_file in part_files:
+        part_file.unlink()
+    # A join the decoder reads differently than planned (lost or doubled frames around the copy)
+    # would shift every later frame, so the segment is encoded whole instead
+    joined_frames = len(read_packet_index(output_file)["frame_times"])
+    if joined_frames != end_frame - start_frame:
+        logging.warning(f"Smart cut {output_file} has {joined_frames} frames instead of {end_frame - start_frame}, re-encoding it")
+        return write_segment(segment, output_file, fps, threads)
+    logging.info(f"Smart cut {output_file}: {copy_end - copy_start} frames copied, {end_frame - start_frame - copy_end + copy_start} encoded")
+    return output_file
+
+
+def target_cache_inputs(target: Dict) -> Dict:
+    # What a target changes about a segment's pixels, its name does not
+    return {"crop": list(target["crop"]), "size": list(target["size"]), "subtitle_scale": target["subtitle_scale"]}
+
+
+def render_segment_task(index: int, replacement_file: Optional[Path], output_file: Path, threads: Optional[int]) -> Optional[Tuple[List[Path], bool]]:
+    # Returns the rendered files, one per target, and whether they came from the segment cache,
+    # or None when the replacement cannot be used and the original segment applies
+    started = time.perf_counter()
+    video = render_state["video"]
+    base_segments = render_state["base_segments"]
+    segment_cache = render_state["segment_cache"]
+    targets = render_state["targets"]
+    output_files = [target_output_file(output_file, target) for target in targets] if targets else [output_file]
+    cache_keys = []
+    replacement_files = {index: replacement_file} if replacement_file is not None else {}
+    if segment_cache is not None:
+        planned_segment = plan_variation_segments(
+            render_state["subtitles"], replacement_files, render_state["input_video_file"], render_state["subtitle_scale"]
+        )[index]
+        if replacement_file is not None and planned_segment["source"] != replacement_file:
+            return None
+        cache_inputs = segment_cache_inputs(index, planned_segment)
+        if targets:
+            cache_keys = [segment_cache_key(dict(cache_inputs, target=target_cache_inputs(target))) for target in targets]
+        else:
+            cache_keys = [segment_cache_key(cache_inputs)]
+        if all(segment_cache.fetch(cache_key, file) for cache_key, file in zip(cache_keys, output_files)):
+            metrics.count("segment_cache_hits")
+            logging.info(f"Reused cached segment: {output_file}")
+            return output_files, True
+    with render_state["replacement_readers"].open(replacement_files) as replacement_videos:
+        segment = replace_video_segments(
+            base_segments, replacement_videos, render_state["subtitles"], video, render_state["subtitle_scale"], add_subtitles=not targets
+        )[index]
+        if replacement_file is not None and segment is base_segments[index]:
+            return None
+        if targets:
+            events = subtitle_events(base_segments[index:index + 1], [segment], render_state["subtitles"][index:index + 1])
+            write_target_segments(segment, output_files, video.fps, threads, events)
+        elif segment is base_segments[index]:
+            write_original_segment(index, output_file, threads)
+        else:
+            write_segment(segment, output_file, video.fps, threads)
+    for cache_key, file in zip(cache_keys, output_files):
+        segment_cache.store(cache_key, file)
+    logging.info(f"Rendered segment: {output_file} in {time.perf_counter() - started:.1f}s")
+    return output_files, False
+
+
+def render_variations(
+    replacement_files_per_combination: List[Dict[int, Path]],
+    pool: Optional[ProcessPoolExecutor],
+    threads: Optional[int],
+    output_folder: Path,
+    audio_file: Optional[Path],
+    job_dir: Path,
+    status: JobStatus
+) -> List[Path]:
+    started = time.perf_counter()
+    tasks = []
+    for i, replacement_files in enumerate(replacement_files_per_combination):
         output_file = output_folder / f"output_variation_{i+1}.mp4"
-        final_video_with_audio.write_videofile(output_file.as_posix(), codec="libx264", audio_codec="aac")
-        #shutil.move(tmp_path, output_file)
-        logging.info(f"Generated output video: {output_file}")
+        tasks.append((variation_output_files(output_folder, i + 1, render_state["targets"]), submit_render_task(
+            pool, render_variation_task, replacement_files, output_file, threads, audio_file, job_dir
+        )))
+    output_files = []
+    for variation_files, task in tasks:
+        task.result()
+        for output_file in variation_files:
+            status.variation_done(output_file)
+            output_files.append(output_file)
+    logging.info(f"Rendered {len(output_files)} variations in {time.perf_counter() - started:.1f}s")
+    return output_files
+
+
+def render_variations_by_segment(
+    replacement_files_per_combination: List[Dict[int, Path]],
+    pool: Optional[ProcessPoolExecutor],
+    threads: Optional[int],
+    output_folder: Path,
+    audio_file: Optional[Path],
+    job_dir: Path,
+    status: JobStatus
+) -> List[Path]:
+    started = time.perf_counter()
+    fps = render_state["video"].fps
+    base_segments = render_state["base_segments"]
+    rendered_indexes = [index for index, segment in enumerate(base_segments) if int(round(segment.duration * fps)) > 0]
+    output_files = []
+    segment_dir = job_dir / "segments"
+    segment_dir.mkdir(exist_ok=True)
+    original_segment_tasks = {}
+
+    def original_segment_task(index):
+        # Untouched segments are identical in every variation, encode them once
+        if index not in original_segment_tasks:
+            original_segment_tasks[index] = submit_render_task(
+                pool, render_segment_task, index, None, segment_dir / f"original_{index:04d}.mp4", threads
+            )
+        return original_segment_tasks[index]
+
+    segment_tasks_per_combination = []
+    for i, replacement_files in enumerate(replacement_files_per_combination):
+        segment_tasks = {}
+        for index in rendered_indexes:
+            if index in replacement_files:
+                segment_tasks[index] = submit_render_task(
+                    pool, render_segment_task, index, replacement_files[index],
+                    segment_dir / f"variation_{i+1}_{index:04d}.mp4", threads
+                )
+            else:
+                segment_tasks[index] = original_segment_task(index)
+        segment_tasks_per_combination.append(segment_tasks)
+
+    rendered_segments = {}
+    for i, segment_tasks in enumerate(segment_tasks_per_combination):
+        # Segment files of every target, in timeline order
+        segment_files = []
+        for index, task in segment_tasks.items():
+            result = task.result()
+            if result is None:
+                # The replacement could not be used, fall back to the original footage
+                result = original_segment_task(index).result()
+            files, cache_hit = result
+            rendered_segments[files[0]] = cache_hit
+            segment_files.append(files)
+        for target_index, output_file in enumerate(variation_output_files(output_folder, i + 1, render_state["targets"])):
+            join_segments([files[target_index] for files in segment_files], audio_file, output_file)
+            logging.info(f"Generated output video: {output_file} after {time.perf_counter() - started:.1f}s")
+            status.variation_done(output_file)
+            output_files.append(output_file)
+    if render_state["segment_cache"] is not None:
+        cache_hits = sum(rendered_segments.values())
+        logging.info(f"Segment cache: {cache_hits} hits, {len(rendered_segments) - cache_hits} misses")
+    logging.info(f"Rendered {len(output_files)} variations in {time.perf_counter() - started:.1f}s")
+    return output_files
+
+
+def plan_subtitle_overlay(subtitle: pysrt.SubRipItem, frame_width: int, font_size: int = 33, color: str = "white", margin: int = 20) -> Dict:
+    # Same look as add_subtitles_to_clip, for renderers that draw the overlay themselves
+    return {
+        "text": subtitle.text,
+        "font": SUBTITLE_FONT,
+        "font_size": font_size,
+        "color": color,
+        "width": frame_width - 2 * margin,
+        "margin": margin,
+        "box_color": SUBTITLE_BOX_COLOR,
+        "box_opacity": SUBTITLE_BOX_OPACITY,
+        "stroke_color": SUBTITLE_STROKE_COLOR,
+        "stroke_width": SUBTITLE_STROKE_WIDTH,
+        "duration": subriptime_to_seconds(subtitle.end) - subriptime_to_seconds(subtitle.start)
+    }
+
+
+def plan_variation_segments(
+    subtitles: pysrt.SubRipFile,
+    replacement_files: Dict[int, Path],
+    input_video_file: Path,
+    subtitle_scale: float = 1.0,
+    targets: Optional[List[Dict]] = None
+) -> List[Dict]:
+    # The timeline built by build_output_segments and replace_video_segments, from container metadata only.
+    # Replaced segments also get their subtitle laid out for each target's width.
+    width, height = probe_video(input_video_file)["video_size"]
+    segments = []
+    previous_end = 0
+    for index, subtitle in enumerate(subtitles):
+        start = subriptime_to_seconds(subtitle.start)
+        end = subriptime_to_seconds(subtitle.end)
+        segment = {"source": input_video_file, "start": start, "end": end, "duration": end - previous_end}
+        previous_end = end
+        if index in replacement_files:
+            replacement_info = probe_video(replacement_files[index])
+            if start >= replacement_info["duration"]:
+                error(f"Start time ({start}) is beyond the replacement video's duration ({replacement_info['duration']}).")
+            else:
+                segment.update(
+                    source=replacement_files[index],
+                    end=min(end, replacement_info["duration"]),
+                    crop=aspect_ratio_crop_box(*replacement_info["video_size"], REPLACEMENT_ASPECT_RATIO),
+                    size=(width, height),
+                    subtitle=plan_subtitle_overlay(subtitle, width, round(33 * subtitle_scale), margin=round(20 * subtitle_scale))
+                )
+                if targets:
+                    segment["target_subtitles"] = {
+                        target["name"]: plan_subtitle_overlay(
+                            subtitle, target["size"][0], round(33 * target["subtitle_scale"]), margin=round(20 * target["subtitle_scale"])
+                        )
+                        for target in targets
+                    }
+        segments.append(segment)
+    return segments
+
+
+def render_filtergraph_task(
+    segments: List[Dict],
+    input_video_file: Path,
+    output_file: Path,
+    work_dir: Path,
+    threads: Optional[int],
+    audio_file: Optional[Path],
+    video_preset: str = VIDEO_PRESET,
+    targets: Optional[List[Dict]] = None
+) -> float:
+    started = time.perf_counter()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    output_files = [target_output_file(output_file, target) for target in targets] if targets else [output_file]
+    with metrics.stage("encoding"):
+        render_variation_with_ffmpeg(
+            segments, input_video_file, output_file, work_dir, VIDEO_CODEC, audio_file, threads, video_preset=video_preset,
+            targets=[dict(target, file=file) for target, file in zip(targets, output_files)] if targets else None
+        )
+    frame_count = int(round(sum(segment["duration"] for segment in segments) * probe_video(input_video_file)["video_fps"]))
+    metrics.count("frames_encoded", frame_count * len(output_files))
+    for source in set(segment["source"] for segment in segments):
+        metrics.count_file("bytes_read", source)
+    for file in output_files:
+        metrics.count_file("bytes_written", file)
+    elapsed = time.perf_counter() - started
+    logging.info(f"Generated output video: {', '.join(str(file) for file in output_files)} in {elapsed:.1f}s")
+    return elapsed
+
+
+def render_variations_with_ffmpeg(
+    subtitles: pysrt.SubRipFile,
+    replacement_files_per_combination: List[Dict[int, Path]],
+    input_video_file: Path,
+    output_folder: Path,
+    workers: int,
+    audio_file: Optional[Path],
+    job_dir: Path,
+    status: JobStatus,
+    video_preset: str = VIDEO_PRESET,
+    subtitle_scale: float = 1.0,
+    targets: Optional[List[Dict]] = None
+) -> List[Path]:
+    started = time.perf_counter()
+    if targets:
+        targets = [target_layout(target, probe_video(input_video_file)["video_size"], subtitle_scale) for target in targets]
+    workers = min(workers, len(replacement_files_per_combination))
+    threads = encoder_threads(workers)
+    # ffmpeg does all the work in its own process, threads are enough to keep several running
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    output_files = []
+    try:
+        tasks = []
+        for i, replacement_files in enumerate(replacement_files_per_combination):
+            segments = plan_variation_segments(subtitles, replacement_files, input_video_file, subtitle_scale, targets)
+            output_file = output_folder / f"output_variation_{i+1}.mp4"
+            tasks.append((variation_output_files(output_folder, i + 1, targets), submit_render_task(
+                pool, render_filtergraph_task, segments, input_video_file, output_file,
+                job_dir / f"variation_{i+1}", threads, audio_file, video_preset, targets
+            )))
+        for variation_files, task in tasks:
+            task.result()
+            for output_file in variation_files:
+                status.variation_done(output_file)
+                output_files.append(output_file)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    logging.info(f"Rendered {len(output_files)} variations in {time.perf_counter() - started:.1f}s")
+    return output_files
+
+
+def segment_loops(segment: Dict) -> int:
+    # Passes over the source a segment needs to fill its slot, as adjust_segment_duration loops it
+    source_duration = segment["end"] - segment["start"]
+    return max(1, math.ceil(segment["duration"] / source_duration - 1e-9)) if source_duration > 0 else 1
+
+
+def plan_job(
+    srt_file: Path,
+    replacement_files_per_combination: List[Dict[int, Path]],
+    input_video_file: Path,
+    output_folder: Path,
+    render_mode: str = "full",
+    backend: str = "moviepy",
+    preview: bool = False,
+    preview_height: int = PREVIEW_HEIGHT,
+    preview_fps: float = PREVIEW_FPS,
+    targets: Optional[List[Dict]] = None
+) -> Dict:
+    # What a job will render, from the subtitles and container metadata only: the timeline, every
+    # variation's replacements with their loops and overlays, its output files and frame counts, and
+    # the work to encode, counted the way the render mode shares it. Previews are planned at the
+    # size and rate of the proxies they would use, without making them.
+    subtitles = load_subtitles_from_file(srt_file)
+    info = probe_video(input_video_file)
+    fps, frame_size = info["video_fps"], info["video_size"]
+    if preview:
+        fps, frame_size = proxy_fps(input_video_file, preview_fps), proxy_size(input_video_file, preview_height)
+    subtitle_scale = frame_size[1] / info["video_size"][1]
+    layouts = [target_layout(target, frame_size, subtitle_scale) for target in targets] if targets else None
+    output_sizes = [layout["size"] for layout in layouts] if layouts else [frame_size]
+
+    def frame_count(segment):
+        return int(round(segment["duration"] * fps))
+
+    timeline = plan_variation_segments(subtitles, {}, input_video_file)
+    variations = []
+    encoded_segments = {}
+    for i, replacement_files in enumerate(replacement_files_per_combination):
+        segments = plan_variation_segments(subtitles, replacement_files, input_video_file, subtitle_scale, layouts)
+        replacements = []
+        for index, segment in enumerate(segments):
+            replaced = segment["source"] != input_video_file
+            if replaced:
+                replacements.append({
+                    "index": index,
+                    "source": Path(segment["source"]).as_posix(),
+                    "start": segment["start"],
+                    "end": segment["end"],
+                    "duration": segment["duration"],
+                    "frames": frame_count(segment),
+                    "loops": segment_loops(segment),
+                    "crop": segment["crop"],
+                    "overlay": segment["subtitle"],
+                    "target_overlays": segment.get("target_subtitles")
+                })
+            # Segments renders encode an untouched segment once for all variations, full renders every time
+            key = (i, index) if replaced or render_mode != "segments" or backend == "ffmpeg" else index
+            encoded_segments[key] = frame_count(segment)
+        variations.append({
+            "index": i + 1,
+            "outputs": [file.name for file in variation_output_files(output_folder, i + 1, layouts)],
+            "frames": sum(frame_count(segment) for segment in segments),
+            "replacements": replacements
+        })
+    frames = sum(encoded_segments.values())
+    return {
+        "version": RENDER_PLAN_VERSION,
+        "input_video": Path(input_video_file).as_posix(),
+        "fps": fps,
+        "size": frame_size,
+        "duration": sum(segment["duration"] for segment in timeline),
+        "render_mode": render_mode,
+        "backend": backend,
+        "preview": preview,
+        "targets": [{"name": layout["name"], "crop": layout["crop"], "size": layout["size"]} for layout in layouts] if layouts else None,
+        "segments": [
+            {
+                "index": index,
+                "start": segment["start"],
+                "end": segment["end"],
+                "duration": segment["duration"],
+                "frames": frame_count(segment),
+                "loops": segment_loops(segment),
+                "text": subtitle.text
+            }
+            for index, (segment, subtitle) in enumerate(zip(timeline, subtitles))
+        ],
+        "variations": variations,
+        "work": {
+            "profile": cost_model.work_profile(backend, render_mode, preview),
+            "variations": len(variations),
+            "outputs": len(variations) * len(output_sizes),
+            "frames_encoded": frames * len(output_sizes),
+            "megapixels_encoded": frames * sum(width * height for width, height in output_sizes) / 1e6
+        }
+    }
+
+
+def make_preview_proxies(
+    input_video_file: Path,
+    replacement_files_per_combination: List[Dict[int, Path]],
+    proxy_dir: Path,
+    height: int,
+    max_fps: float,
+    workers: int
+) -> (Path, List[Dict[int, Path]]):
+    # Low-resolution stand-ins for every source; the timeline, subtitles and replacement mapping stay the same
+    replacement_video_files = sorted(set(file for replacement_files in replacement_files_per_combination for file in replacement_files.values()))
+    with metrics.stage("proxies"), ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        input_proxy = pool.submit(make_proxy, input_video_file, proxy_dir, height, max_fps)
+        replacement_proxies = dict(zip(
+            replacement_video_files, pool.map(lambda file: make_proxy(file, proxy_dir, height, max_fps, audio=False), replacement_video_files)
+        ))
+        input_proxy = input_proxy.result()
+    logging.info(f"Using {len(replacement_proxies) + 1} proxies at {height}p for the preview")
+    return input_proxy, [
+        {replace_index: replacement_proxies[file] for replace_index, file in replacement_files.items()}
+        for replacement_files in replacement_files_per_combination
+    ]
+
+
+def main(video_clips_path, my_video, mp3_file_of_same_video, txt_file_of_same_video, output_folder, render_mode="full", workers=1, backend="moviepy",
+         segment_cache_dir=None, segment_cache_bytes=DEFAULT_SEGMENT_CACHE_BYTES,
+         alignment_cache_dir=None, chunked_alignment=False, max_open_readers=DEFAULT_MAX_OPEN_READERS, smart_cut=False,
+         status_file=None, metrics_file=None, preview=False, preview_height=PREVIEW_HEIGHT, preview_fps=PREVIEW_FPS,
+         proxy_cache_dir=None, targets=None, loop_cache_bytes=DEFAULT_LOOP_CACHE_BYTES, dry_run=False, plan_file=None,
+         history_dir=None):
+    # A dry run stops after planning, without touching the job's status or metrics files
+    started = time.perf_counter()
+    rss_sampler = metrics.RssSampler().start()
+    input_video_file = Path(my_video)
+    replacement_base_folder = Path(video_clips_path)
+
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    status = JobStatus(None if dry_run else status_file)
+    status.update(state="aligning")
+    plan = None
+
+    try:
+        targets = [parse_target(target) for target in targets] if targets else None
+        replacement_files_per_combination = find_replacement_video_files(replacement_base_folder)
+        if dry_run:
+            # Plans may be made while the job's own alignment or render runs, so the aligner is not run
+            # and the subtitles planned with are kept apart from the job's
+            with tempfile.TemporaryDirectory(prefix="plan_") as plan_dir:
+                srt_file, aligned = estimate_srt_from_txt_and_audio(
+                    Path(txt_file_of_same_video), Path(mp3_file_of_same_video), Path(plan_dir) / "plan.srt",
+                    alignment_cache_dir=alignment_cache_dir, chunked_alignment=chunked_alignment
+                )
+                plan = plan_job(
+                    srt_file, replacement_files_per_combination, input_video_file, output_folder, render_mode, backend,
+                    preview, preview_height, preview_fps, targets
+                )
+        else:
+            # Generate SRT file from TXT and MP3
+            with metrics.stage("alignment"):
+                srt_file = generate_srt_from_txt_and_audio(
+                    Path(txt_file_of_same_video), Path(mp3_file_of_same_video), output_folder,
+                    alignment_cache_dir=alignment_cache_dir, chunked_alignment=chunked_alignment
+                )
+            logging.info("Generated SRT file from TXT and MP3")
+            aligned = True
+            plan = plan_job(
+                srt_file, replacement_files_per_combination, input_video_file, output_folder, render_mode, backend,
+                preview, preview_height, preview_fps, targets
+            )
+        plan["aligned"] = aligned
+        calibration = cost_model.calibrate(cost_model.read_history(history_dir)) if history_dir else {}
+        plan["estimate"] = cost_model.estimate(plan["work"], calibration)
+        if plan_file:
+            metrics.write_report(plan, Path(plan_file))
+        logging.info(
+            f"Planned {plan['work']['outputs']} outputs, {plan['work']['frames_encoded']} frames to encode, "
+            f"estimated {plan['estimate']['seconds']:.0f}s"
+        )
+        if dry_run:
+            print(json.dumps(plan, indent=2))
+            return
+        status.start_rendering([
+            output_file for i in range(len(replacement_files_per_combination))
+            for output_file in variation_output_files(output_folder, i + 1, targets)
+        ])
+
+        with tempfile.TemporaryDirectory(prefix="job_") as job_dir:
+            video_preset = VIDEO_PRESET
+            subtitle_scale = 1.0
+            if preview:
+                # The same plan as a full render, drawn from proxies; without a proxy cache they last for this job only
+                proxy_dir = Path(proxy_cache_dir) if proxy_cache_dir else Path(job_dir) / "proxies"
+                input_proxy, replacement_files_per_combination = make_preview_proxies(
+                    input_video_file, replacement_files_per_combination, proxy_dir, preview_height, preview_fps, workers
+                )
+                subtitle_scale = proxy_scale(input_video_file, input_proxy)
+                input_video_file = input_proxy
+                video_preset = PREVIEW_PRESET
+            render_job(
+                input_video_file, srt_file, replacement_files_per_combination, output_folder, Path(job_dir), render_mode,
+                workers, backend, segment_cache_dir, segment_cache_bytes, max_open_readers, smart_cut, status,
+                video_preset, subtitle_scale, targets, loop_cache_bytes
+            )
+    except Exception as e:
+        status.update(state="failed", error=str(e))
+        raise
+    finally:
+        rss_sampler.stop()
+        clear_caption_caches()
+        report = metrics.job_report(time.perf_counter() - started)
+        logging.info("Stage timings: " + ", ".join(
+            f"{name} {totals['seconds']:.1f}s" for name, totals in sorted(report["stages"].items(), key=lambda item: -item[1]["seconds"])
+        ))
+        if plan is not None:
+            # The work the plan counted, for calibrating estimates against what the job took
+            report["plan"] = dict(plan["work"], estimated_seconds=plan["estimate"]["seconds"])
+        if metrics_file and not dry_run:
+            metrics.write_report(report, Path(metrics_file))
+    status.update(state="done")
+
+
+def render_job(input_video_file, srt_file, replacement_files_per_combination, output_folder, job_dir, render_mode, workers, backend,
+               segment_cache_dir, segment_cache_bytes, max_open_readers, smart_cut=False, status=None, video_preset=VIDEO_PRESET,
+               subtitle_scale=1.0, targets=None, loop_cache_bytes=DEFAULT_LOOP_CACHE_BYTES):
+    status = status or JobStatus()
+    # job_dir holds the job's encoded audio and intermediate files, it is removed with the job
+    if backend == "ffmpeg":
+        if render_mode != "full":
+            logging.warning(f"Render mode {render_mode} is not used by the ffmpeg backend, rendering full variations")
+        subtitles = load_subtitles_from_file(srt_file)
+        logging.info("Loaded SRT Subtitles from the provided subtitle file")
+        audio_file = prepare_job_audio(input_video_file, subriptime_to_seconds(subtitles[-1].end), job_dir)
+        render_variations_with_ffmpeg(
+            subtitles, replacement_files_per_combination, input_video_file, output_folder, workers, audio_file, job_dir, status,
+            video_preset, subtitle_scale, targets
+        )
+        return
+
+    if segment_cache_dir and render_mode != "segments":
+        logging.warning("The segment cache is only used by the segments render mode")
+    smart_cut_index = None
+    if smart_cut and render_mode != "segments":
+        logging.warning("Smart cut is only used by the segments render mode")
+    elif smart_cut and targets:
+        logging.warning("Smart cut is not used with targets, every target is cropped and scaled from decoded frames")
+    elif smart_cut:
+        smart_cut_index = keyframe_index(input_video_file, segment_cache_dir)
+        video_info = probe_video(input_video_file)
+        parameter_sets = encoder_parameter_sets(tuple(video_info["video_size"]), video_info["video_fps"], video_preset)
+        if not stream_copy_compatible(smart_cut_index, video_info["video_fps"], VIDEO_STREAM_CODEC, VIDEO_PIX_FMT, parameter_sets):
+            logging.warning(
+                f"{input_video_file} is not constant frame rate {VIDEO_STREAM_CODEC} {VIDEO_PIX_FMT} with the "
+                f"parameter sets of {VIDEO_CODEC} {video_preset}, re-encoding every segment"
+            )
+            smart_cut_index = None
+    if render_mode == "full":
+        workers = min(workers, len(replacement_files_per_combination))
+    # The loop frame cache budget is the job's, every render process gets its share
+    loop_cache_bytes //= max(1, workers)
+    threads = encoder_threads(workers)
+    pool = None
+    try:
+        init_render_worker(input_video_file, srt_file, render_mode, segment_cache_dir=segment_cache_dir,
+                           segment_cache_bytes=segment_cache_bytes, max_open_readers=max_open_readers,
+                           smart_cut_index=smart_cut_index, video_preset=video_preset, subtitle_scale=subtitle_scale, targets=targets,
+                           loop_cache_bytes=loop_cache_bytes)
+        timeline = render_state["base_segments"] if render_mode == "segments" else render_state["output_video_segments"]
+        audio_file = prepare_job_audio(input_video_file, sum(segment.duration for segment in timeline), job_dir)
+
+        pool = create_render_pool(
+            workers, input_video_file, srt_file, render_mode, segment_cache_dir, segment_cache_bytes, max_open_readers, smart_cut_index,
+            video_preset, subtitle_scale, targets, loop_cache_bytes
+        )
+        if pool is not None:
+            logging.info(f"Rendering with {workers} workers, {threads} encoder threads each")
+        if render_mode == "segments":
+            render_variations_by_segment(
+                replacement_files_per_combination, pool, threads, output_folder, audio_file, job_dir, status
+            )
+        else:
+            render_variations(replacement_files_per_combination, pool, threads, output_folder, audio_file, job_dir, status)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        close_render_state()
 
 
 if __name__ == "__main__":
@@ -242,7 +1462,55 @@ if __name__ == "__main__":
     parser.add_argument("--input_mp3", "-im", required=True, help="Input mp3 file")
     parser.add_argument("--input_txt", "-it", required=True, help="Input txt file")
     parser.add_argument("--output_dir", "-o", required=True, help="Output directory")
+    parser.add_argument("--render_mode", "-rm", choices=["full", "segments"], default="full",
+                        help="Render every variation in full, or encode shared segments once and join them")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of render processes; encoder threads are split between them")
+    parser.add_argument("--backend", "-b", choices=["moviepy", "ffmpeg"], default="moviepy",
+                        help="Render through moviepy, or build one ffmpeg filtergraph per variation")
+    parser.add_argument("--segment_cache_dir", "-scd", default=None,
+                        help="Directory keeping rendered segments across jobs (segments render mode)")
+    parser.add_argument("--segment_cache_size", "-scs", type=float, default=DEFAULT_SEGMENT_CACHE_BYTES / 1024 ** 3,
+                        help="Segment cache size limit in GB, least recently used segments are evicted beyond it")
+    parser.add_argument("--alignment_cache_dir", "-acd", default=None,
+                        help="Directory keeping forced alignments of mp3/txt pairs across jobs")
+    parser.add_argument("--chunked_alignment", "-ca", action="store_true",
+                        help="Align paragraphs of long narrations in parallel and stitch the timings")
+    parser.add_argument("--max_open_readers", "-mor", type=int, default=DEFAULT_MAX_OPEN_READERS,
+                        help="Replacement clips each render process keeps open at once")
+    parser.add_argument("--smart_cut", "-sc", action="store_true",
+                        help="Stream-copy whole GOPs of untouched segments, encoding only around the cuts (segments render mode)")
+    parser.add_argument("--status_file", "-sf", default=None,
+                        help="JSON file kept up to date with the job state and finished variations")
+    parser.add_argument("--metrics_file", "-mf", default=None,
+                        help="JSON report of the job's stage timings, frames, bytes and peak memory")
+    parser.add_argument("--preview", "-p", action="store_true",
+                        help="Render every variation quickly at low resolution from proxies of the inputs")
+    parser.add_argument("--preview_height", "-ph", type=int, default=PREVIEW_HEIGHT,
+                        help="Height of preview renders in pixels")
+    parser.add_argument("--preview_fps", "-pf", type=float, default=PREVIEW_FPS,
+                        help="Frame rate cap of preview renders")
+    parser.add_argument("--proxy_cache_dir", "-pcd", default=None,
+                        help="Directory keeping low-resolution proxies of inputs across previews")
+    parser.add_argument("--targets", "-t", nargs="+", default=None,
+                        help="Aspect ratios like 9:16, or with a size like 9:16@1080x1920, to cut every variation to in the same pass")
+    parser.add_argument("--loop_cache_size", "-lcs", type=float, default=DEFAULT_LOOP_CACHE_BYTES / 1024 ** 3,
+                        help="Decoded frames of looped segments kept in memory by the job, in GB, shared between its render processes; longer loops are decoded again on every pass")
+    parser.add_argument("--dry_run", "-dr", action="store_true",
+                        help="Print the render plan and its estimated time as JSON, without rendering")
+    parser.add_argument("--plan_file", "-plf", default=None,
+                        help="JSON file the render plan and its estimate are written to")
+    parser.add_argument("--history_dir", "-hd", default=None,
+                        help="Directory searched for metrics.json reports of past jobs to calibrate the estimate with")
 
     args = parser.parse_args()
-    main(args.input_clips, args.input_video, args.input_mp3, args.input_txt, Path(args.output_dir))
+    main(args.input_clips, args.input_video, args.input_mp3, args.input_txt, Path(args.output_dir),
+         render_mode=args.render_mode, workers=args.workers, backend=args.backend,
+         segment_cache_dir=args.segment_cache_dir, segment_cache_bytes=int(args.segment_cache_size * 1024 ** 3),
+         alignment_cache_dir=args.alignment_cache_dir, chunked_alignment=args.chunked_alignment,
+         max_open_readers=args.max_open_readers, smart_cut=args.smart_cut, status_file=args.status_file,
+         metrics_file=args.metrics_file, preview=args.preview, preview_height=args.preview_height,
+         preview_fps=args.preview_fps, proxy_cache_dir=args.proxy_cache_dir, targets=args.targets,
+         loop_cache_bytes=int(args.loop_cache_size * 1024 ** 3), dry_run=args.dry_run, plan_file=args.plan_file,
+         history_dir=args.history_dir)
 
@@ -1,12 +1,51 @@
 import os
+import subprocess
+import sys
+import threading
+import time
 import uuid
 import datetime
-from flask import Flask, render_template_string, request, send_from_directory
-from threading import Thread
+from flask import Flask, Response, abort, jsonify, render_template_string, request, send_from_directory, url_for
+from werkzeug.utils import secure_filename
 import shutil
 
+from job_queue import JobQueue, QueueFull
+from streaming_upload import UploadError, UploadSession
+from zip_stream import stored_zip_size, stream_stored_zip
+
 app = Flask(__name__)
 
+# Rendered segments are kept here between jobs, so resubmitted inputs only re-render what changed
+SEGMENT_CACHE_DIR = os.path.join(os.getcwd(), 'segment_cache')
+ALIGNMENT_CACHE_DIR = os.path.join(os.getcwd(), 'alignment_cache')
+# Low-resolution proxies of uploaded videos, for preview jobs
+PROXY_CACHE_DIR = os.path.join(os.getcwd(), 'proxy_cache')
+# Every job writes its variations to its own directory under here, named by job id
+OUTPUT_ROOT = os.path.join('static', 'output_root')
+
+# Jobs rendering at once, and jobs allowed to wait for a worker before new uploads are refused
+RENDER_JOB_WORKERS = int(os.environ.get('RENDER_JOB_WORKERS', 1))
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', 4))
+# Jobs a warm render process takes, and its resident memory in MB, before it is replaced. Memory is
+# only checked between jobs; each of the RENDER_JOB_WORKERS jobs also holds up to its 0.5 GB loop frame cache
+RENDER_WORKER_MAX_JOBS = int(os.environ.get('RENDER_WORKER_MAX_JOBS', 25))
+RENDER_WORKER_MAX_RSS_MB = int(os.environ.get('RENDER_WORKER_MAX_RSS_MB', 4096))
+
+job_queue = JobQueue(RENDER_JOB_WORKERS, MAX_QUEUED_JOBS, RENDER_WORKER_MAX_JOBS, RENDER_WORKER_MAX_RSS_MB * 1024 ** 2, history_dir=OUTPUT_ROOT)
+# Chunked uploads still in progress, by job id
+upload_sessions = {}
+# How often uploads idle for longer than the queue's UPLOAD_IDLE_TIMEOUT are looked for and dropped
+UPLOAD_SWEEP_SECONDS = 5 * 60
+
+def sweep_uploads():
+    # Abandoned uploads would otherwise keep their session, their partial files and their job for good
+    while True:
+        time.sleep(UPLOAD_SWEEP_SECONDS)
+        for job_id in job_queue.expire_uploads():
+            upload_sessions.pop(job_id, None)
+
+threading.Thread(target=sweep_uploads, daemon=True).start()
+
 def generate_unique_id():
     return str(uuid.uuid4())
 
@@ -66,6 +105,69 @@ def index():
             function displayMessage() {
                 document.getElementById("waitMessage").innerText = "Please wait for files uploading process. Don't close the page.";
             }
+
+            // Files go up in chunks, the narration and text first so alignment can start while
+            // the video and clips are still uploading. A failed chunk is retried from the offset
+            // the server reports, so a dropped connection only repeats the chunk in flight.
+            var CHUNK_SIZE = 8 * 1024 * 1024;
+            var UPLOAD_ORDER = ["text_file", "mp3_file", "video_file", "clips_folder"];
+
+            async function uploadFile(jobId, field, file) {
+                var url = "/upload/" + jobId + "/" + field;
+                var offset = 0;
+                var failures = 0;
+                // Empty files still send their one empty chunk, or they would never complete
+                do {
+                    var end = Math.min(offset + CHUNK_SIZE, file.size);
+                    var query = "?filename=" + encodeURIComponent(file.name) + "&offset=" + offset + "&total=" + file.size;
+                    try {
+                        var response = await fetch(url + query, {method: "PUT", body: file.slice(offset, end)});
+                        var status = await response.json();
+                        if (!response.ok && response.status != 409) {
+                            throw new Error(status.error);
+                        }
+                        offset = status.received;
+                        failures = 0;
+                    } catch (error) {
+                        if (++failures > 5) {
+                            throw error;
+                        }
+                        await new Promise(function(resolve) { setTimeout(resolve, 1000 * failures); });
+                        var resumed = await fetch(url).then(function(response) { return response.json(); });
+                        offset = resumed.received;
+                    }
+                    document.getElementById("waitMessage").innerText =
+                        "Uploading " + file.name + ": " + Math.floor(100 * offset / Math.max(1, file.size)) + "%";
+                } while (offset < file.size);
+            }
+
+            async function uploadAll(event) {
+                event.preventDefault();
+                displayMessage();
+                var form = event.target;
+                try {
+                    var response = await fetch("/upload", {method: "POST"});
+                    var job = await response.json();
+                    if (!response.ok) {
+                        throw new Error(job.error);
+                    }
+                    for (var field of UPLOAD_ORDER) {
+                        await uploadFile(job.job_id, field, form.elements[field].files[0]);
+                    }
+                    var options = new URLSearchParams({targets: form.elements["targets"].value});
+                    if (form.elements["preview"].checked) {
+                        options.set("preview", "1");
+                    }
+                    response = await fetch("/upload/" + job.job_id + "/submit?" + options, {method: "POST"});
+                    var submitted = await response.json();
+                    if (!response.ok) {
+                        throw new Error(submitted.error);
+                    }
+                    window.location = submitted.download;
+                } catch (error) {
+                    document.getElementById("waitMessage").innerText = "Upload failed: " + error.message;
+                }
+            }
             function downloadAll() {
                 // Get all file names
                 var files = [
@@ -92,11 +194,13 @@ def index():
     <body>
         <div class="container">
             <h1>Scene Optimisation Bot</h1>
-            <form action="/process" method="post" enctype="multipart/form-data" onsubmit="displayMessage()">
+            <form action="/process" method="post" enctype="multipart/form-data" onsubmit="uploadAll(event)">
                 Video File <input type="file" name="video_file" required><br>
                 Clips (zip) <input type="file" name="clips_folder" required><br>
                 MP3 File <input type="file" name="mp3_file" required><br>
                 Text File <input type="file" name="text_file" required><br>
+                Aspect ratios <input type="text" name="targets" placeholder="9:16 1:1@1080x1080 (optional)"><br>
+                <label><input type="checkbox" name="preview"> Quick low-resolution preview</label><br>
                 <input type="submit" value="Process">
             </form>
             <h1 id="waitMessage"></h1>
@@ -105,49 +209,82 @@ def index():
     </html>
     ''')
 
-def remove_all_files_in_directory(directory):
+def render_arguments(job_id, video_file_path, clips_dir, mp3_file_path, text_file_path, preview=False, targets=None):
+    # test.main's arguments, for a warm render worker; targets like 9:16 or 9:16@1080x1920 are rendered in the same pass
+    final_out_path = os.path.join(OUTPUT_ROOT, job_id)
+    return dict(
+        video_clips_path=clips_dir, my_video=video_file_path, mp3_file_of_same_video=mp3_file_path,
+        txt_file_of_same_video=text_file_path, output_folder=final_out_path,
+        render_mode='segments', segment_cache_dir=SEGMENT_CACHE_DIR,
+        alignment_cache_dir=ALIGNMENT_CACHE_DIR, smart_cut=True,
+        status_file=os.path.join(final_out_path, 'status.json'),
+        metrics_file=os.path.join(final_out_path, 'metrics.json'),
+        preview=preview, proxy_cache_dir=PROXY_CACHE_DIR if preview else None, targets=targets or None
+    )
+
+@app.route('/upload', methods=['POST'])
+def create_upload():
+    job_id = generate_unique_id()
     try:
-        if os.path.exists(directory):
-            for filename in os.listdir(directory):
-                file_path = os.path.join(directory, filename)
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.remove(file_path)
-                    print(f"Removed file {file_path}")
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-                    print(f"Removed directory {file_path}")
-        else:
-            print(f"Directory {directory} does not exist")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+        job_queue.register(job_id, os.path.join(OUTPUT_ROOT, job_id), os.path.join('tmp', job_id))
+    except QueueFull:
+        return jsonify(error="Too many jobs are waiting, try again later"), 503, {'Retry-After': '60'}
+    upload_sessions[job_id] = UploadSession(os.path.join('tmp', job_id))
+    return jsonify(job_id=job_id)
+
+@app.route('/upload/<job_id>/<field>', methods=['GET', 'PUT'])
+def upload_chunk(job_id, field):
+    session = upload_sessions.get(job_id)
+    if session is None:
+        abort(404)
+    accepted = True
+    if request.method == 'PUT':
+        filename = secure_filename(request.args.get('filename', '')) or field
+        try:
+            accepted = session.write_chunk(
+                field, filename, request.args.get('offset', type=int), request.args.get('total', type=int), request.stream
+            )
+        except UploadError as e:
+            return jsonify(error=str(e)), 400
+        job_queue.touch(job_id)
+        start_alignment(job_id, session)
+    status = session.status().get(field, {"received": 0, "total": None, "complete": False})
+    return jsonify(status), 200 if accepted else 409
+
+def start_alignment(job_id, session):
+    # The render job waits for this instead of aligning again, it finds the result in the cache
+    with session.lock:
+        if session.alignment is not None or not session.complete('mp3_file', 'text_file'):
+            return
+        session.alignment = subprocess.Popen([
+            sys.executable, 'alignment.py', '--input_mp3', str(session.path('mp3_file')),
+            '--input_txt', str(session.path('text_file')), '--alignment_cache_dir', ALIGNMENT_CACHE_DIR
+        ])
+    job_queue.add_prerequisite(job_id, session.alignment)
+
+@app.route('/upload/<job_id>/submit', methods=['POST'])
+def submit_upload(job_id):
+    session = upload_sessions.get(job_id)
+    if session is None:
+        abort(404)
+    if not session.complete():
+        return jsonify(error="Some files have not been uploaded completely", files=session.status()), 409
+    arguments = render_arguments(
+        job_id, str(session.path('video_file')), str(session.clips_dir), str(session.path('mp3_file')), str(session.path('text_file')),
+        preview=request.args.get('preview') == '1', targets=request.args.get('targets', '').split()
+    )
+    job_queue.submit(job_id, arguments, os.path.join(OUTPUT_ROOT, job_id), session.job_dir)
+    del upload_sessions[job_id]
+    return jsonify(job_id=job_id, download=url_for('download', job_id=job_id))
 
 @app.route('/process', methods=['POST'])
 def process():
-    static_out_file_server = os.path.join('static', 'output_root')
-    tmp = os.path.join(os.getcwd(), 'tmp')
-    final_out_path = os.path.join('static', 'output_root', 'final')
-    outpath = os.path.join(static_out_file_server, f'output')
-    
-    try:
-        remove_all_files_in_directory(f"{os.path.join(outpath, 'videos')}")
-        remove_all_files_in_directory(f"{os.path.join(outpath, 'audios')}")
-        remove_all_files_in_directory(final_out_path)
-        tmp_dirs = os.listdir(tmp)
-        for dir in tmp_dirs:
-            remove_all_files_in_directory(os.path.join(tmp, dir))
-        remove_all_files_in_directory(tmp)
-    except:
-        pass
-    
-    try:
-        os.makedirs(outpath)
-        os.makedirs(f"{os.path.join(outpath, 'audios')}")
-        os.makedirs(f"{os.path.join(outpath, 'videos')}")
-        os.makedirs(f"{os.path.join('static', 'output_root', 'final')}")
-    except:
-        pass
-    
-    unique_special_id = os.path.join('tmp', generate_unique_id())
+    if not job_queue.accepting():
+        return jsonify(error="Too many jobs are waiting, try again later"), 503, {'Retry-After': '60'}
+
+    job_id = generate_unique_id()
+    final_out_path = os.path.join(OUTPUT_ROOT, job_id)
+    unique_special_id = os.path.join('tmp', job_id)
     
     video_dir = os.path.join(unique_special_id, "video")
     clips_dir = os.path.join(unique_special_id, "clips")
@@ -176,12 +313,15 @@ def process():
     
     shutil.unpack_archive(clips_folder_path, clips_dir)
     
-    def run_script():
-        cmd = f'python3.10 test.py --input_video "{video_file_path}" --input_clips "{clips_dir}" --input_mp3 "{mp3_file_path}" --input_txt "{text_file_path}" --output_dir "{final_out_path}"'
-        print(cmd)
-        os.system(cmd)
-    
-    Thread(target=run_script).start()
+    arguments = render_arguments(
+        job_id, video_file_path, clips_dir, mp3_file_path, text_file_path, preview='preview' in request.form,
+        targets=request.form.get('targets', '').split()
+    )
+    try:
+        job_queue.submit(job_id, arguments, final_out_path, unique_special_id)
+    except QueueFull:
+        shutil.rmtree(unique_special_id, ignore_errors=True)
+        return jsonify(error="Too many jobs are waiting, try again later"), 503, {'Retry-After': '60'}
 
     return render_template_string('''
     <!DOCTYPE html>
@@ -222,15 +362,20 @@ def process():
         <div class="container">
             <h1>Uploaded Successfully</h1><br>
             <h1>Now click Download to access the files </h1>
-            <a href="/download">Download <---</a>
+            <a href="{{ url_for('download', job_id=job_id) }}">Download <---</a>
         </div>
     </body>
     </html>
-    ''')
+    ''', job_id=job_id)
 
-@app.route('/download/')
-def download():
-    files = os.listdir('static/output_root/final')
+@app.route('/download/<job_id>')
+def download(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        abort(404)
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(status)
+    files = status['files']
     return render_template_string('''
     <!DOCTYPE html>
     <html>
@@ -287,11 +432,11 @@ def download():
     <body>
         <div class="container">
             <h1>Available Files</h1><br>
-            <h3>Note:</h3><br>
-            <p>Keep refreshing the page, it will show the generated files. Download your file from here.</p>
+            <h3 id="jobState">{{ status.state }} ({{ status.variations_done }}/{{ status.variations_total }} variations)</h3><br>
+            <p>This page refreshes itself until the job is done. Download your files from here.</p>
             <ul id="fileList">
                 {% for file in files %}
-                <li><a href="{{ url_for('download_file', filename=file) }}">{{ file }}</a></li>
+                <li><a href="{{ url_for('download_file', job_id=job_id, filename=file) }}">{{ file }}</a></li>
                 {% endfor %}
             </ul>
             <button class="download-all-btn" onclick="downloadAll()">Download All</button>
@@ -299,34 +444,64 @@ def download():
 
         <script>
             function downloadAll() {
-                // Get all file names
-                var files = [
-                    {% for file in files %}
-                        "{{ file }}",
-                    {% endfor %}
-                ];
-
-                // Create a temporary anchor element
-                var link = document.createElement("a");
-
-                // Loop through each file and trigger download
-                files.forEach(function(file) {
-                    // Set the href attribute of the anchor element
-                    link.setAttribute("href", "/download/" + file);
-                    // Set the download attribute to force download
-                    link.setAttribute("download", file);
-                    // Simulate click on the anchor element
-                    link.click();
-                });
+                // One request for a ZIP of every finished variation, built while it downloads
+                window.location = "{{ url_for('download_all', job_id=job_id) }}";
             }
+
+            // Poll the job status until it has finished, then show the final file list
+            {% if status.state not in ['done', 'failed'] %}
+            setInterval(function() {
+                fetch("/download/{{ job_id }}?format=json")
+                    .then(function(response) { return response.json(); })
+                    .then(function(status) {
+                        if (status.files.length != {{ files|length }} || status.state == "done" || status.state == "failed") {
+                            window.location.reload();
+                        }
+                        var progress = status.state + " (" + status.variations_done + "/" + status.variations_total + " variations)";
+                        if (status.position !== null) {
+                            progress += ", " + status.position + " jobs ahead";
+                        }
+                        if (status.eta_seconds !== null) {
+                            progress += ", about " + Math.max(1, Math.ceil(status.eta_seconds / 60)) + " min left";
+                        }
+                        document.getElementById("jobState").innerText = progress;
+                    });
+            }, 3000);
+            {% endif %}
         </script>
     </body>
     </html>
-    ''', files=files)
+    ''', files=files, status=status, job_id=job_id)
+
+@app.route('/download/<job_id>/all')
+def download_all(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        abort(404)
+    files = [os.path.join(OUTPUT_ROOT, job_id, filename) for filename in status['files']]
+    if not files:
+        abort(404)
+    return Response(
+        stream_stored_zip(files),
+        mimetype='application/zip',
+        headers={
+            'Content-Length': str(stored_zip_size(files)),
+            'Content-Disposition': f'attachment; filename="{job_id}.zip"'
+        }
+    )
+
+@app.route('/download/<job_id>/<filename>')
+def download_file(job_id, filename):
+    status = job_queue.status(job_id)
+    # Only finished variations, a range resumed from a file still being written would not fit together
+    if status is None or filename not in status['files']:
+        abort(404)
+    # Conditional responses answer Range requests with partial content, so interrupted downloads resume
+    return send_from_directory(os.path.join(OUTPUT_ROOT, job_id), filename, as_attachment=True, conditional=True)
 
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory('static/output_root/final', filename, as_attachment=True)
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(job_queue.prometheus_text(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0')
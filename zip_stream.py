@@ -0,0 +1,111 @@
+import struct
+import time
+import zlib
+from pathlib import Path
+from typing import Iterator, List
+
+# Bytes of a file read from disk per chunk of the archive
+ZIP_STREAM_BUFFER_SIZE = 1024 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+LOCAL_HEADER_FORMAT = "<4sHHHHHIIIHH"
+CENTRAL_HEADER_FORMAT = "<4sHHHHHHIIIHHHHHII"
+END_RECORD_FORMAT = "<4sHHHHIIH"
+ZIP64_END_RECORD_FORMAT = "<4sQHHIIQQQQ"
+ZIP64_LOCATOR_FORMAT = "<4sIQI"
+
+
+def dos_time(file: Path):
+    modified = time.localtime(max(Path(file).stat().st_mtime, 315532800))
+    return (
+        (modified.tm_hour << 11) | (modified.tm_min << 5) | (modified.tm_sec // 2),
+        ((modified.tm_year - 1980) << 9) | (modified.tm_mon << 5) | modified.tm_mday
+    )
+
+
+def file_crc(file: Path) -> int:
+    crc = 0
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(ZIP_STREAM_BUFFER_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def local_header(name: bytes, size: int, crc: int, modified) -> bytes:
+    # Sizes past 4 GiB move into a zip64 extra field
+    zip64 = size >= ZIP64_LIMIT
+    extra = struct.pack("<HHQQ", 1, 16, size, size) if zip64 else b""
+    stored_size = ZIP64_LIMIT if zip64 else size
+    return struct.pack(
+        LOCAL_HEADER_FORMAT, b"PK\x03\x04", 45 if zip64 else 20, 0, 0, modified[0], modified[1],
+        crc, stored_size, stored_size, len(name), len(extra)
+    ) + name + extra
+
+
+def central_header(name: bytes, size: int, crc: int, modified, offset: int) -> bytes:
+    zip64_fields = [value for value in (size, size) if value >= ZIP64_LIMIT]
+    if offset >= ZIP64_LIMIT:
+        zip64_fields.append(offset)
+    extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b""
+    version = 45 if zip64_fields else 20
+    return struct.pack(
+        CENTRAL_HEADER_FORMAT, b"PK\x01\x02", version, version, 0, 0, modified[0], modified[1], crc,
+        min(size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0, 0o100644 << 16,
+        min(offset, ZIP64_LIMIT)
+    ) + name + extra
+
+
+def end_records(entries: int, directory_offset: int, directory_size: int) -> bytes:
+    records = b""
+    if entries >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+        zip64_end_offset = directory_offset + directory_size
+        records += struct.pack(
+            ZIP64_END_RECORD_FORMAT, b"PK\x06\x06", 44, 45, 45, 0, 0, entries, entries, directory_size, directory_offset
+        )
+        records += struct.pack(ZIP64_LOCATOR_FORMAT, b"PK\x06\x07", 0, zip64_end_offset, 1)
+    return records + struct.pack(
+        END_RECORD_FORMAT, b"PK\x05\x06", 0, 0, min(entries, 0xFFFF), min(entries, 0xFFFF),
+        min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0
+    )
+
+
+def stored_zip_size(files: List[Path]) -> int:
+    # Headers only depend on names and sizes, so the archive length is known before any CRC
+    offset = 0
+    directory_size = 0
+    for file in files:
+        name = Path(file).name.encode('utf-8')
+        size = Path(file).stat().st_size
+        offset_before = offset
+        offset += len(local_header(name, size, 0, (0, 0))) + size
+        directory_size += len(central_header(name, size, 0, (0, 0), offset_before))
+    return offset + directory_size + len(end_records(len(files), offset, directory_size))
+
+
+def stream_stored_zip(files: List[Path]) -> Iterator[bytes]:
+    # A ZIP of the files without compression (video does not compress further), produced while it
+    # is sent instead of written to disk first. Each file's CRC is read just before its entry so
+    # the local headers carry real sizes and every unzip tool can follow the stream.
+    offset = 0
+    directory = []
+    for file in files:
+        file = Path(file)
+        name = file.name.encode('utf-8')
+        size = file.stat().st_size
+        crc = file_crc(file)
+        modified = dos_time(file)
+        header = local_header(name, size, crc, modified)
+        directory.append(central_header(name, size, crc, modified, offset))
+        yield header
+        with open(file, 'rb') as f:
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(remaining, ZIP_STREAM_BUFFER_SIZE))
+                if not chunk:
+                    raise RuntimeError(f"{file} shrank while it was being zipped")
+                remaining -= len(chunk)
+                yield chunk
+        offset += len(header) + size
+    directory_data = b"".join(directory)
+    yield directory_data
+    yield end_records(len(files), offset, len(directory_data))